@@ -1,17 +1,39 @@
 import struct
-import argparse
+import bisect
+import contextlib
+import fnmatch
+import glob
+import hashlib
+import io
+import itertools
+import json
+import marshal
+import mmap
+import os
+import threading
+import time
 import zlib
 
+from collections import OrderedDict, deque
 from pathlib import Path
 
+U08 = struct.Struct("<B")
+U16 = struct.Struct("<H")
+U32 = struct.Struct("<I")
+FILE_ENTRY = struct.Struct("<IIHB5x") # Data offset, file size, compression flag, checksum
+PATCH_HEADER = struct.Struct("<8sIQQ20sQ20s") # Magic, version, old BIN size, old header length, old header hash, new BIN size, new BIN hash
+PATCH_OP = struct.Struct("<BQQ") # Operation, offset in the old BIN, length
+PATCH_MAGIC = b"PBPSDIFF"
+(PATCH_COPY, PATCH_DATA, PATCH_ZERO, PATCH_END) = (0, 1, 2, 0xFF)
+
 def ru08(buf, offset):
-    return struct.unpack("<B", buf[offset:offset+1])[0] # Some of these are unused but it's nice to have them around
+    return U08.unpack_from(buf, offset)[0] # Some of these are unused but it's nice to have them around
 
 def ru16(buf, offset):
-    return struct.unpack("<H", buf[offset:offset+2])[0]
+    return U16.unpack_from(buf, offset)[0]
 
 def ru32(buf, offset):
-    return struct.unpack("<I", buf[offset:offset+4])[0]
+    return U32.unpack_from(buf, offset)[0]
 
 def wu08(value):
     return struct.pack("<B", value)
@@ -23,22 +45,37 @@ def wu32(value):
     return struct.pack("<I", value)
 
 def deZLib(buf, offset, size): # Decompress a ZLib-compressed file
-    localBuffer = buf[offset:offset+size]
+    localBuffer = memoryview(buf)[offset:offset+size] # No need to copy the compressed data first
     decompressed = zlib.decompress(localBuffer)
-    return bytes(decompressed) # Array of byte integers
+    return decompressed # Array of byte integers
+
+def map_file(path): # Get a read-only view of a whole file without reading it into memory
+    with open(path, "rb") as input_file:
+        try:
+            mapped = mmap.mmap(input_file.fileno(),0,access=mmap.ACCESS_READ)
+        except ValueError: # Empty files can't be mapped
+            return memoryview(b"")
+    return memoryview(mapped) # The view keeps the map open, and slicing it doesn't copy anything
 
 def get_align_difference(num, alignment=0x800): # Get alignment difference for padding purposes
     difference = (alignment-(num%alignment))%alignment
     return difference
 
-def get_file_checksum(buffer): # Calculate XOR checksum for a file
-    checksum = 0x00
-    for byte in buffer: # Say goodbye to our Big O
-        checksum ^= byte
+def get_file_checksum(buffer, chunkSize=0x10000): # Calculate XOR checksum for a file
+    view = memoryview(bytes(buffer) if isinstance(buffer, list) else buffer).cast("B")
+    checksum = 0
+    for offset in range(0,len(view),chunkSize): # XOR whole chunks at once as big integers...
+        checksum ^= int.from_bytes(view[offset:offset+chunkSize],"little")
+    width = 1
+    while width < min(len(view),chunkSize):
+        width *= 2
+    while width > 1: # ...then fold the result in half until only one byte is left
+        width //= 2
+        checksum = (checksum >> (width*8)) ^ (checksum & ((1 << (width*8)) - 1))
     return checksum
 
 def determine_extension(buf, qbFile): # QuickBMS's extensions are iconic but I'm in charge here so we use internal filenames by default
-    magic = buf[0:4]
+    magic = bytes(buf[0:4])
     if magic[0:3].isalnum():
         magicString = magic.decode("UTF-8").rstrip("\x00")
     else:
@@ -55,12 +92,12 @@ def determine_extension(buf, qbFile): # QuickBMS's extensions are iconic but I'm
             return "tx2" # I made this one up
     elif magic == bytearray([0x00, 0x10, 0x00, 0x10]): # Camera info for battle intros
         return "cam" # Cutscenes use a format called "lcm" but it's not the same one
-    elif magic == bytearray([0x21, 0x01, 0xF0, 0xFF]) or buf[0:8] == bytearray([0x03, 0x00, 0x00, 0x00, 0x01, 0x00, 0x00, 0x00]): # Commonly known as DAT
+    elif magic == bytearray([0x21, 0x01, 0xF0, 0xFF]) or bytes(buf[0:8]) == bytearray([0x03, 0x00, 0x00, 0x00, 0x01, 0x00, 0x00, 0x00]): # Commonly known as DAT
         if qbFile: # The title screen files in particular have no headers
             return "dat"
         else:
             return "lxe"
-    elif buf[0:8] == bytearray([0x01, 0x00, 0x00, 0x00, 0x01, 0x00, 0x00, 0x00]): # Portrait overlays
+    elif bytes(buf[0:8]) == bytearray([0x01, 0x00, 0x00, 0x00, 0x01, 0x00, 0x00, 0x00]): # Portrait overlays
         if qbFile:
             return "dat"
         else:
@@ -72,6 +109,21 @@ def determine_extension(buf, qbFile): # QuickBMS's extensions are iconic but I'm
     else:
         return "bin"
 
+def detect_container(head, size): # Is this file a BIN of its own? Returns "bin", "effModel" or "" going by its first bytes and full size
+    if len(head) >= 0x10 and ru32(head,0x08) == 0x20031205: # Same marker extract_file() checks for
+        folderCount = ru32(head,0x00)
+        headerLength = ru32(head,0x04)
+        if folderCount > 0 and 0x10+(folderCount*0x10) <= headerLength <= size:
+            return "bin"
+    elif len(head) >= 0x14: # eff.bin is just a list of sizes, so they have to add up exactly
+        folderCount = ru32(head,0x00)
+        headerLength = 0x04+(folderCount*0x10)
+        if folderCount > 0 and headerLength <= len(head):
+            dataLength = sum(fileSize for (fileSize,) in struct.iter_unpack("<I",head[0x04:headerLength]))
+            if dataLength > 0 and headerLength+dataLength == size:
+                return "effModel"
+    return ""
+
 def numsort(str): # Because default numeric string sorting is the worst
     numstr = ""
     for c in str:
@@ -82,86 +134,260 @@ def numsort(str): # Because default numeric string sorting is the worst
     else:
         return -1 # And if there are none, lowest priority
 
-def parse_filelist(infile): # Convert the filelist into a two-dimensional array
-    outarray = []
-    with open(infile) as filelist:
-        lines = filelist.readlines() # Get each text line from the file
-        for line in lines:
-            if line != "\n": # Make sure the line isn't empty
-                linearray = [] # [Folder num, file num, name folder, name stem]
-                filePos = line.split(":",1)[0] # Everything before ":" (file position)
-                fileName = line.split(":",1)[1] # Everything after ":" (file name)
-                fileName = fileName.strip("\n\"") # Remove quotation marks from name
-                linearray += filePos.split("/") # Split position by "/" and add both elements
-                linearray += fileName.rsplit("/",1) # Split name by last "/" and add both elements
-                while len(outarray) <= int(linearray[0]):
-                    outarray.append([])
-                outarray[int(linearray[0])].insert(int(linearray[1]),linearray) # Add to the appropriate array
-    return outarray
+STATS = None # The Stats being collected, or None. Nothing is timed unless enable_stats() has been called
+
+class Stats: # Time, bytes in and out, and call counts for each phase of the work
+    def __init__(self):
+        self.phases = {} # Phase name to [calls, seconds, bytes in, bytes out]
+        self.lock = threading.Lock() # Jobs report from several threads at once
+        self.start = time.perf_counter()
+        self.elapsed = 0.0
+        self.originals = {}
+
+    def add(self, phase, seconds, bytesIn=0, bytesOut=0):
+        with self.lock:
+            record = self.phases.setdefault(phase,[0,0.0,0,0])
+            record[0] += 1
+            record[1] += seconds
+            record[2] += bytesIn
+            record[3] += bytesOut
+
+    def as_dict(self):
+        return {"elapsed": self.elapsed, "phases": {phase: {"calls": calls, "seconds": seconds, "bytesIn": bytesIn, "bytesOut": bytesOut} for phase, (calls,seconds,bytesIn,bytesOut) in self.phases.items()}}
+
+    def report(self): # A table for the console. Phases that call other phases include their time
+        lines = [f"{'Phase':<20}{'Calls':>10}{'Time':>11}{'Share':>8}{'MB in':>10}{'MB out':>10}{'MB/s':>10}"]
+        for phase, (calls,seconds,bytesIn,bytesOut) in sorted(self.phases.items(),key=lambda item: -item[1][1]):
+            share = seconds/self.elapsed*100 if self.elapsed > 0 else 0
+            speed = max(bytesIn,bytesOut)/seconds/0x100000 if seconds > 0 else 0
+            lines.append(f"{phase:<20}{calls:>10}{seconds:>10.3f}s{share:>7.1f}%{bytesIn/0x100000:>10.2f}{bytesOut/0x100000:>10.2f}{speed:>10.1f}")
+        lines.append(f"{'Total':<20}{'':>10}{self.elapsed:>10.3f}s")
+        return "\n".join(lines)
+
+    def save(self, path): # For comparing runs later
+        with open(path, "w") as stats_file:
+            json.dump(self.as_dict(),stats_file,indent=4)
+
+class TimedWriter: # Stands in for an output file while stats are on, timing every write
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, data):
+        start = time.perf_counter()
+        count = self.file.write(data)
+        stats = STATS
+        if stats is not None:
+            stats.add("output I/O",time.perf_counter()-start,0,len(data))
+        return count
+
+    def __getattr__(self, name):
+        return getattr(self.file,name)
+
+def track_output(file): # Wrap an output file if stats are on, otherwise hand it straight back
+    if STATS is None:
+        return file
+    return TimedWriter(file)
+
+def timed(phase, func, measure): # Wrap func so every call counts towards phase. measure(args, result) gives (bytes in, bytes out)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter()-start
+        stats = STATS
+        if stats is not None:
+            stats.add(phase,elapsed,*measure(args,result))
+        return result
+    wrapper.__wrapped__ = func
+    return wrapper
+
+STATS_PHASES = [ # [Phase, function, how to get (bytes in, bytes out) from its arguments and result]
+    ["parse_filelist", "parse_filelist", lambda args, result: (os.path.getsize(args[0]),0)],
+    ["parse_header", "parse_header", lambda args, result: (sum(len(folder) for folder in result)*(0x04 if len(args) > 2 and args[2] else FILE_ENTRY.size),0)],
+    ["deZLib", "deZLib", lambda args, result: (args[2],len(result))],
+    ["append_file", "append_file", lambda args, result: (0,result[0])],
+    ["pack_file", "pack_file", lambda args, result: (len(args[0]),len(result[0]))],
+    ["get_file_checksum", "get_file_checksum", lambda args, result: (len(args[0]),0)],
+    ["rebuild_header", "rebuild_header", lambda args, result: (0,len(result))],
+    ["output I/O", "copy_range", lambda args, result: (0,args[3] if result else 0)],
+]
+
+def enable_stats(): # Start timing every phase. Returns the Stats, which fill in as work is done
+    global STATS
+    if STATS is not None:
+        return STATS
+    stats = Stats()
+    module = globals()
+    for (phase,name,measure) in STATS_PHASES: # Swap the plain functions for timed ones, so there's no cost at all while stats are off
+        stats.originals[name] = module[name]
+        module[name] = timed(phase,module[name],measure)
+    readinto = EntryReader.readinto
+    stats.originals["readinto"] = readinto
+    def timed_readinto(self, b): # Streamed decompression doesn't go through deZLib(), but it's the same work
+        position = self.position
+        start = time.perf_counter()
+        count = readinto(self,b)
+        if self.compressed:
+            stats.add("deZLib",time.perf_counter()-start,min(self.position,self.end)-min(position,self.end),count)
+        return count
+    EntryReader.readinto = timed_readinto
+    STATS = stats
+    return stats
+
+def disable_stats(): # Put the plain functions back. Returns the finished Stats, or None if they weren't on
+    global STATS
+    stats = STATS
+    if stats is None:
+        return None
+    STATS = None
+    stats.elapsed = time.perf_counter()-stats.start
+    EntryReader.readinto = stats.originals.pop("readinto")
+    globals().update(stats.originals)
+    return stats
+
+class FileList: # Two-way index between (folder, file) numbers and file list names
+    __slots__ = ("folders", "lookup")
+
+    def __init__(self, folders):
+        self.folders = folders # One list of names per folder, indexed by file number. Missing files are None
+        self.lookup = None # Name to (folder, file). Only built if someone asks
+
+    def __len__(self):
+        return len(self.folders)
+
+    def file_count(self, folder):
+        if folder < len(self.folders):
+            return len(self.folders[folder])
+        return 0
+
+    def get_path(self, folder, file): # "game/chr/chr_list.chr" for 2/0, or None if it isn't listed
+        if folder < len(self.folders) and file < len(self.folders[folder]):
+            return self.folders[folder][file]
+        return None
+
+    def find(self, path): # (folder, file) for a name, or None if it isn't listed
+        if self.lookup is None:
+            self.lookup = {}
+            for i in range(len(self.folders)):
+                for j in range(len(self.folders[i])):
+                    if self.folders[i][j] is not None:
+                        self.lookup[self.folders[i][j]] = (i,j)
+        return self.lookup.get(path)
+
+FILELIST_INDEX_VERSION = 1
+
+def compile_filelist(text): # Convert the filelist text into one list of names per folder
+    folders = []
+    for line in text.splitlines():
+        if len(line) > 0: # Make sure the line isn't empty
+            (filePos,fileName) = line.split(":",1) # File position and file name
+            (folder,file) = filePos.split("/")
+            (folder,file) = (int(folder),int(file))
+            while len(folders) <= folder:
+                folders.append([])
+            while len(folders[folder]) <= file: # Lines aren't always in order
+                folders[folder].append(None)
+            folders[folder][file] = fileName.strip("\"") # Remove quotation marks from name
+    return folders
+
+LOADED_FILELISTS = {} # (path, stamp) to folders, for every filelist this process has already loaded
+
+def parse_filelist(infile): # Load the filelist, using the compiled index next to it when it's up to date
+    indexPath = Path(infile).with_suffix(".idx")
+    listStat = os.stat(infile)
+    stamp = (listStat.st_mtime_ns,listStat.st_size)
+    loadedKey = (str(Path(infile).resolve()),stamp)
+    if loadedKey in LOADED_FILELISTS: # Batch workers get theirs handed over, and everything else only loads it once
+        return FileList(LOADED_FILELISTS[loadedKey])
+    indexHash = None
+    try:
+        with open(indexPath, "rb") as index_file:
+            (version,indexStamp,indexHash,folders) = marshal.load(index_file)
+        if version != FILELIST_INDEX_VERSION:
+            indexHash = None
+        elif indexStamp == stamp:
+            LOADED_FILELISTS[loadedKey] = folders
+            return FileList(folders)
+    except (OSError, EOFError, ValueError, TypeError):
+        indexHash = None
+    with open(infile, "rb") as filelist:
+        text = filelist.read()
+    textHash = hashlib.sha1(text).hexdigest()
+    if textHash != indexHash: # Same contents with a new timestamp (e.g. after a checkout) don't need compiling again
+        folders = compile_filelist(text.decode("UTF-8"))
+    try:
+        with open(indexPath, "wb") as index_file:
+            marshal.dump((FILELIST_INDEX_VERSION,stamp,textHash,folders),index_file)
+    except OSError: # Not being able to cache it isn't the end of the world
+        pass
+    LOADED_FILELISTS[loadedKey] = folders
+    return FileList(folders)
 
 def parse_header(buf,folderCount,effModel=False): # Convert the header into a two-dimensional array
     outarray = []
-    fileAdjust = False # 12/0 and 27/0 are listed at the wrong locations in the vanilla header
+    view = memoryview(buf)
     if effModel:
-        folderOffset = 0x04
-        dataOffset = folderOffset+(folderCount*0x10)
-    else:
-        folderOffset = 0x10
+        dataOffset = 0x04+(folderCount*0x10)
+        for (fileSize,) in struct.iter_unpack("<I",view[0x04:dataOffset]): # A list of four sizes per folder
+            if len(outarray) == 0 or len(outarray[-1]) == 4:
+                outarray.append([]) # Set up inner array
+            outarray[-1].append([dataOffset,fileSize,0,0]) # [File offset, file size, compressed, checksum]. There's no flag or checksum for this format
+            dataOffset += fileSize
+        return outarray
     for i in range(folderCount):
-        outarray.append([]) # Set up inner array
-        if effModel:
-            fileOffset = folderOffset
-            fileCount = 4
-        else:
-            fileOffset = ru32(buf,folderOffset) # This only needs to exist in files with variable folders
-            fileCount = ru32(buf,folderOffset+4)
-        for j in range(fileCount):
-            filearray = [] # [File offset, file size, compressed, checksum]
-            if effModel:
-                filearray.append(dataOffset)
-                filearray.append(ru32(buf,fileOffset))
-                filearray.append(0) # There's no flag for this
-                filearray.append(0) # This isn't in the format
-                dataOffset += ru32(buf,fileOffset)
-                fileOffset += 0x04
-            else:
-                dataOffset = ru32(buf,fileOffset)
-                if i == 12 and j == 0 and dataOffset == 0x29D2000:
-                    fileOffset = ru32(buf,0x10+(0x10*27)) # The aforementioned header fix
-                    fileAdjust = True
-                    dataOffset = ru32(buf,fileOffset)
-                elif i == 27 and j == 0 and dataOffset == 0x52A800:
-                    fileOffset = ru32(buf,0x10+(0x10*12)) # We check the offset because in any other case than vanilla we'll have already fixed it
-                    fileAdjust = True
-                    dataOffset = ru32(buf,fileOffset)
-                compressed = (ru16(buf,fileOffset+8)&0x2000) # Check compression
-                compressed >>= 13
-                filearray.append(dataOffset) # Add each value to the file's array entry
-                filearray.append(ru32(buf,fileOffset+4))
-                filearray.append(compressed)
-                filearray.append(ru08(buf,fileOffset+10))
-                if fileAdjust:
-                    fileOffset = ru32(buf,0x10+(0x10*i))
-                    fileAdjust = False
-                fileOffset += 0x10
-            outarray[i].append(filearray)
-        folderOffset += 0x10
+        (fileOffset,fileCount) = struct.unpack_from("<II",view,0x10+(0x10*i)) # This only needs to exist in files with variable folders
+        entries = view[fileOffset:fileOffset+(fileCount*FILE_ENTRY.size)]
+        filearray = [[dataOffset,fileSize,(flags&0x2000)>>13,checksum] for (dataOffset,fileSize,flags,checksum) in FILE_ENTRY.iter_unpack(entries)] # [File offset, file size, compressed, checksum]
+        if fileCount > 0: # 12/0 and 27/0 are listed at the wrong locations in the vanilla header
+            if i == 12 and filearray[0][0] == 0x29D2000:
+                fileOffset = ru32(view,0x10+(0x10*27)) # The aforementioned header fix
+            elif i == 27 and filearray[0][0] == 0x52A800: # We check the offset because in any other case than vanilla we'll have already fixed it
+                fileOffset = ru32(view,0x10+(0x10*12))
+            (dataOffset,fileSize,flags,checksum) = FILE_ENTRY.unpack_from(view,fileOffset)
+            filearray[0] = [dataOffset,fileSize,(flags&0x2000)>>13,checksum]
+        outarray.append(filearray)
     return outarray
 
 def get_file_data(buf,offset,size,compressed=0): # Get (and decompress if necessary) a file as a bytearray
     if compressed == 1:
         size += get_align_difference(size) # The English patch messed up the sizes
-        tempBuf = buf[offset+4:offset+size] # It's easier to just bake the fix in
-        fileData = deZLib(tempBuf,0,len(tempBuf)) # Decompress if needed
+        fileData = deZLib(buf,offset+4,size-4) # It's easier to just bake the fix in
         if not len(fileData) == ru32(buf,offset):
             print(f"Incorrect file size specified! Attempting to ignore...")
     else:
         if size > 0:
-            fileData = buf[offset:offset+size]
+            fileData = memoryview(buf)[offset:offset+size] # A view, not a copy
         else:
             fileData = []
     return fileData
 
+def copy_range(srcFd, dstFd, offset, size): # Let the kernel copy part of one file into another
+    while size > 0:
+        try:
+            if hasattr(os,"copy_file_range"):
+                copied = os.copy_file_range(srcFd,dstFd,size,offset)
+            elif hasattr(os,"sendfile"):
+                copied = os.sendfile(dstFd,srcFd,offset,size)
+            else:
+                return False
+        except OSError: # Not every filesystem supports this
+            return False
+        if copied == 0:
+            return False
+        offset += copied
+        size -= copied
+    return True
+
+def write_file_data(outpath, fileData, srcFd=None, srcOffset=0): # Write a file in one go. With srcFd, uncompressed data is copied straight from the input BIN
+    with open(outpath, "wb") as outfile:
+        outfile = track_output(outfile)
+        if srcFd is not None:
+            if copy_range(srcFd,outfile.fileno(),srcOffset,len(fileData)):
+                return 0
+            outfile.seek(0) # Start over the old-fashioned way
+            outfile.truncate()
+        outfile.write(fileData)
+    return 0
+
 def get_file_name(buffer,folder,file,filelist=[],model=False,qbFile=False,noFolder=False): # Determine the path where the file should be stored
     outext = determine_extension(buffer,qbFile)
     if model:
@@ -176,62 +402,196 @@ def get_file_name(buffer,folder,file,filelist=[],model=False,qbFile=False,noFold
         if not noFolder:
             outpath = (f"{folder}/{outpath}")
     else:
-        if len(filelist) > 0:
-            outpath = (f"{filelist[folder][file][3]}")
-            if not noFolder:
-                outpath = (f"{filelist[folder][file][2]}/{outpath}")
+        if len(filelist) > 0 and filelist.get_path(folder,file) is not None:
+            outpath = filelist.get_path(folder,file)
+            if noFolder:
+                outpath = outpath.rsplit("/",1)[-1]
         elif not noFolder:
             outpath = (f"{folder}/{file}.{outext}")
         else:
             outpath = (f"{folder}_{file}.{outext}")
     return outpath
 
-def append_file(input,databuffer,folder,compress=True,effModel=False): # Add file to the end of the buffer
+class CompressionCache: # Keeps compressed files on disk so a rebuild only recompresses what changed
+    def __init__(self, path, maxSize=1024*1024*1024):
+        self.path = Path(path)
+        self.maxSize = maxSize # In bytes. The least recently used entries go first
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, fileData, settings): # Same contents and same settings means the same output
+        return (f"{hashlib.sha1(fileData).hexdigest()}-{settings}")
+
+    def get(self, key): # Returns (compressed data, checksum) or None
+        entryPath = self.path/key[0:2]/key
+        try:
+            with open(entryPath, "rb") as entry_file:
+                entryData = entry_file.read()
+            os.utime(entryPath) # Mark as recently used
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return (entryData[1:],entryData[0])
+
+    def put(self, key, fileData, checksum):
+        entryPath = self.path/key[0:2]/key
+        entryPath.parent.mkdir(parents=True,exist_ok=True)
+        tempPath = entryPath.with_name(f"{key}.{os.getpid()}.{threading.get_ident()}.tmp") # Other workers might want the same key
+        with open(tempPath, "wb") as entry_file:
+            entry_file.write(wu08(checksum))
+            entry_file.write(fileData)
+        os.replace(tempPath,entryPath)
+
+    def trim(self): # Evict old entries until we fit within the size limit
+        if not self.path.is_dir():
+            return 0
+        entries = []
+        totalSize = 0
+        for entryPath in self.path.glob("*/*"):
+            entryStat = entryPath.stat()
+            entries.append((entryStat.st_mtime,entryStat.st_size,entryPath))
+            totalSize += entryStat.st_size
+        entries.sort()
+        removed = 0
+        for (mtime,size,entryPath) in entries:
+            if totalSize <= self.maxSize:
+                break
+            entryPath.unlink()
+            totalSize -= size
+            removed += 1
+            if not any(entryPath.parent.iterdir()): # Don't leave empty folders behind either
+                entryPath.parent.rmdir()
+        return removed
+
+class BuildManifest: # Remembers where every unpacked file came from, so a rebuild can skip the ones that haven't changed
+    def __init__(self, binPath, effModel=False):
+        self.binPath = Path(binPath).resolve()
+        self.effModel = effModel
+        self.entries = {} # Path within the folder to [size, mtime, hash, offset, stored size, compressed, checksum, header size, compression settings]. The stored size is None if we never found out where the compressed data ends
+        self.buf = None
+
+    def add(self, path, size, mtime, fileHash, offset, storedSize, compressed, checksum, headerSize, settings):
+        self.entries[path] = [size,mtime,fileHash,offset,storedSize,compressed,checksum,headerSize,settings]
+
+    def save(self, folder):
+        binStat = self.binPath.stat()
+        manifest = {"version": 2, "bin": str(self.binPath), "binSize": binStat.st_size, "binMtime": binStat.st_mtime_ns, "effModel": self.effModel, "entries": self.entries}
+        try:
+            with open(Path(folder)/"manifest.json", "w") as manifest_file:
+                json.dump(manifest,manifest_file)
+        except OSError: # We can live without it
+            print(f"Couldn't write a manifest to {folder}. Incremental rebuilds won't be available.")
+
+    @classmethod
+    def load(cls, folder, effModel=False): # Returns None unless the manifest and the BIN it describes are both still there and untouched
+        try:
+            with open(Path(folder)/"manifest.json") as manifest_file:
+                manifest = json.load(manifest_file)
+            binStat = os.stat(manifest["bin"])
+        except (OSError, ValueError, KeyError):
+            return None
+        if manifest.get("version") != 2 or manifest["effModel"] != effModel or (binStat.st_size,binStat.st_mtime_ns) != (manifest["binSize"],manifest["binMtime"]):
+            return None
+        loaded = cls(manifest["bin"],effModel)
+        loaded.entries = manifest["entries"]
+        loaded.buf = map_file(loaded.binPath)
+        return loaded
+
+    def reuse(self, path, filePath, fileStat, allowed, settings): # (stored data, checksum, compressed, source info, True) if the file hasn't changed since, otherwise None. allowed is which compression flags will do
+        entry = self.entries.get(path)
+        if entry is None or entry[0] != fileStat.st_size or entry[5] not in allowed:
+            return None
+        if allowed != (0,) and entry[8] != settings: # Compressed some other way than we would now
+            return None
+        (size,mtime,fileHash,offset,storedSize,compressed,checksum) = entry[0:7]
+        if mtime != fileStat.st_mtime_ns: # Touched, but maybe not changed
+            with open(filePath, "rb") as input_file:
+                if hashlib.sha1(input_file.read()).hexdigest() != fileHash:
+                    return None
+            mtime = fileStat.st_mtime_ns
+        if storedSize is None: # We don't know where the compressed data really ends, since the English patch messed up the sizes
+            storedSize = get_stream_size(self.buf,offset,entry[7])
+            if storedSize is None:
+                return None # Broken, so pack it from scratch instead
+            checksum = get_file_checksum(self.buf[offset:offset+storedSize]) # As a fresh rebuild would have it
+        return (self.buf[offset:offset+storedSize],checksum,compressed,[path,size,mtime,fileHash],True)
+
+    def close(self):
+        self.buf = None
+
+def get_cache_path(folder): # The cache lives next to the unpacked folder
+    folderPath = Path(folder).resolve()
+    return folderPath.with_name(f"{folderPath.name}.cache")
+
+COMPRESSION_LEVELS = { # zlib settings tried for each level, as (level, memLevel, strategy). The smallest result wins
+    "fast": [(1,8,zlib.Z_DEFAULT_STRATEGY)], # For test builds
+    "default": [(zlib.Z_DEFAULT_COMPRESSION,8,zlib.Z_DEFAULT_STRATEGY)],
+    "max": [(9,9,zlib.Z_DEFAULT_STRATEGY)],
+    "auto": [(9,9,zlib.Z_DEFAULT_STRATEGY),(9,9,zlib.Z_FILTERED),(6,9,zlib.Z_DEFAULT_STRATEGY),(9,9,zlib.Z_RLE)],
+}
+COMPRESSION_POOL = None # Shared by every file, so "auto" can try its settings side by side
+
+def get_sector_count(size): # How many 0x800-byte sectors a file takes up on the disc
+    return (size+get_align_difference(size))//0x800
+
+def compress_data(fileData, level="default"): # Compress with every setting the level asks for and keep the smallest
+    global COMPRESSION_POOL
+    if level == "default":
+        return zlib.compress(fileData) # Exactly what we've always produced
+    candidates = COMPRESSION_LEVELS[level]
+
+    def try_setting(setting):
+        compressor = zlib.compressobj(setting[0],zlib.DEFLATED,zlib.MAX_WBITS,setting[1],setting[2])
+        return compressor.compress(fileData)+compressor.flush()
+
+    if len(candidates) > 1 and len(fileData) >= 0x10000: # zlib lets go of the GIL, so bigger files can be tried in parallel
+        if COMPRESSION_POOL is None:
+            from concurrent.futures import ThreadPoolExecutor # Slow to import, and most runs don't need it
+            COMPRESSION_POOL = ThreadPoolExecutor(max_workers=min(len(candidates),os.cpu_count() or 1))
+        results = list(COMPRESSION_POOL.map(try_setting,candidates))
+    else:
+        results = [try_setting(setting) for setting in candidates]
+    return min(results,key=len)
+
+def get_compression_settings(level="default"): # Everything that changes what compression gives us, for the cache and the manifest
+    settings = f"zlib{zlib.ZLIB_RUNTIME_VERSION}"
+    if level != "default":
+        settings += f"-{level}"
+    return settings
+
+def pack_file(fileData,folder,compress=True,effModel=False,cache=None,level="default"): # Get a file's data as it will be stored in the BIN. Returns (data, checksum, compressed)
+    if effModel or not (compress or folder == 8): # Game can go into an infinite loop if we don't force folder 8
+        return (fileData,get_file_checksum(fileData),0)
+    cached = None
+    if cache is not None:
+        key = cache.make_key(fileData,get_compression_settings(level))
+        cached = cache.get(key)
+    if cached is not None:
+        (packed,checksum) = cached
+    else:
+        packed = wu32(len(fileData)) + compress_data(fileData,level)
+        checksum = get_file_checksum(packed)
+        if cache is not None:
+            cache.put(key,packed,checksum)
+    if level == "auto" and folder != 8 and get_sector_count(len(packed)) >= get_sector_count(len(fileData)): # Not a single sector saved, and the file would load slower
+        return (fileData,get_file_checksum(fileData),0)
+    return (packed,checksum,1)
+
+def read_packed_file(input,folder,compress=True,effModel=False,cache=None,level="default"): # Read a file from disk and pack it
     with open(input, "rb") as input_file:
-        fileData = bytearray( input_file.read() )
-        fileSize = len(fileData)
-        if not effModel and (compress or folder == 8): # Game can go into an infinite loop if we don't force folder 8
-            fileData = zlib.compress(fileData)
-            fileData = wu32(fileSize) + fileData
-            databuffer.extend(fileData)
-            fileSize = len(fileData)
-        else:
-            databuffer.extend(fileData)
-        input_file.close()
+        fileData = input_file.read()
+    return pack_file(fileData,folder,compress,effModel,cache,level)
+
+def append_file(input,databuffer,folder,compress=True,effModel=False,cache=None,level="default"): # Add file to the end of the buffer. Returns (size, checksum, compressed)
+    (fileData,checksum,compressed) = read_packed_file(input,folder,compress,effModel,cache,level)
+    fileSize = len(fileData)
+    databuffer.extend(fileData)
     if not effModel:
         databuffer.extend(bytearray(get_align_difference(fileSize))) # PS2 games would take a bullet to be 0x800-aligned
-    return (fileSize,get_file_checksum(fileData))
-
-def modify_header(buf, folder, file, newsize, compress=True, checksum=-1, effModel=False): # Adjust header to change one file
-    if effModel:
-        fileOffset = 0x04+(folder*0x10)+(file*0x04) # List of sizes
-        buf[fileOffset:fileOffset+4] = wu32(newsize) # Just find the one we need and change it
-    else:
-        folderCount = ru32(buf,0)
-        difference = 0 # This will keep track of how much we need to adjust things by
-        for i in range(folderCount-folder): # Skip to the folder we need. We'll make up for it as we go
-            fileOffset = ru32(buf, 0x10+(i+folder)*0x10)
-            fileCount = ru32(buf, 0x14+(i+folder)*0x10)
-            for j in range(fileCount):
-                curFile = fileOffset+(0x10*j) # Find the offset for the file
-                if i == 0 and j <= file: # Don't do anything until we get to the replacement file
-                    if j == file: # We're at the replacement file
-                        curFileSize = ru32(buf,curFile+4)+get_align_difference(ru32(buf,curFile+4))
-                        difference += newsize+get_align_difference(newsize) # Calculate difference
-                        difference -= curFileSize
-                        buf[curFile+4:curFile+8] = wu32(newsize)
-                        if compress or folder == 8: # Set compression flag
-                            buf[curFile+8:curFile+10] = wu16(0x2000)
-                        else:
-                            buf[curFile+8:curFile+10] = wu16(0)
-                        if checksum != -1:
-                            buf[curFile+10:curFile+11] = wu08(checksum)
-                else: # This runs for all files after the replacement
-                    curFileOffset = ru32(buf,curFile)
-                    buf[curFile:curFile+4] = wu32(curFileOffset+difference) # Add the difference
-    return 0
+    return (fileSize,checksum,compressed)
 
-def rebuild_header(headerarray, effModel=False): # Reconstruct a BIN file header from a two-dimensional array
+def rebuild_header(headerarray, effModel=False, useOffsets=False): # Reconstruct a BIN file header from a two-dimensional array. With useOffsets, each file's offset is taken from the array instead of laid out in order
     newheader = bytearray(0)
     newheader.extend(wu32(len(headerarray))) # Both types start with the number of folders
 
@@ -255,7 +615,10 @@ def rebuild_header(headerarray, effModel=False): # Reconstruct a BIN file header
         for j in range(len(headerarray[i])):
             setFile = headerarray[i][j]
             if not effModel:
-                newheader.extend(wu32(fileLength)) # Data offset
+                if useOffsets:
+                    newheader.extend(wu32(setFile[0])) # Deduplicated files share their data, so they can't just go in order
+                else:
+                    newheader.extend(wu32(fileLength)) # Data offset
             newheader.extend(wu32(setFile[1])) # The special case eff.bin only uses file sizes
             if not effModel:
                 newheader.extend(wu16(setFile[2]*0x2000)) # Compression
@@ -272,12 +635,44 @@ def rebuild_header(headerarray, effModel=False): # Reconstruct a BIN file header
         newheader.extend(padding)
     return newheader
 
-def extract_file(buf, folder, lookFolder, lookFile, model=False, useFilelist=True, qbFile=False, fileName=""):
+def verify_checksums(buf, model=False): # Check every file against the checksum in the header
+    folderCount = ru32(buf,0x00) # Number of folders
+    if model and ru32(buf,0x08) != 0x20031205: # 9/0 (game/eff/eff.bin) is a unique case
+        print(f"This model file has no checksums to verify!")
+        return (0,[])
+    files = parse_header(buf,folderCount)
+    view = memoryview(buf)
+    checked = 0
+    mismatches = [] # [Folder, file, header checksum, actual checksum, seconds taken]
+    for i in range(folderCount):
+        for j in range(len(files[i])):
+            getFile = files[i][j]
+            start = time.perf_counter()
+            checksum = get_file_checksum(view[getFile[0]:getFile[0]+getFile[1]]) # The checksum covers the data as stored, so no decompression
+            elapsed = time.perf_counter()-start
+            checked += 1
+            if checksum != getFile[3]:
+                mismatches.append([i,j,getFile[3],checksum,elapsed])
+    return (checked,mismatches)
+
+def match_files(files, targets, lines=[]): # Turn (folder, file) pairs and name patterns into a list of (folder, file) pairs
+    matched = []
+    for target in targets:
+        if isinstance(target, str): # Patterns match "folder/file" numbers as well as filelist names
+            for i in range(len(files)):
+                for j in range(len(files[i])):
+                    names = [f"{i}/{j}"]
+                    if len(lines) > 0 and lines.get_path(i,j) is not None:
+                        names.append(lines.get_path(i,j))
+                    if any(fnmatch.fnmatchcase(name,target) for name in names):
+                        matched.append((i,j))
+        else:
+            matched.append((target[0],target[1]))
+    return list(dict.fromkeys(matched)) # Drop duplicates but keep the order
+
+def extract_files(buf, folder, targets, model=False, useFilelist=True, qbFile=False, fileName="", srcFd=None, noFolder=True, jobs=1): # Extract any number of files, parsing everything only once
     folderCount = ru32(buf,0x00) # Number of folders
     effModel = False
-    if lookFolder > (folderCount - 1): # Does the folder exist?
-        print(f"Invalid file {lookFolder}/{lookFile}: There are only {folderCount} folders in this file!")
-        return -1
     if model and ru32(buf,0x08) != 0x20031205: # 9/0 (game/eff/eff.bin) is a unique case
         effModel = True
 
@@ -286,62 +681,448 @@ def extract_file(buf, folder, lookFolder, lookFile, model=False, useFilelist=Tru
         lines = parse_filelist("./filelist.txt")
 
     files = parse_header(buf,folderCount,effModel) # Set up our directory structure
-    
-    if lookFile > len(files[lookFolder]): # Does the file exist?
-        print(f"Invalid file {lookFolder}/{lookFile}: There are only {len(files[lookFolder])} file(s) in this folder!")
-        return -1
-    getFile = files[lookFolder][lookFile]
-    fileData = get_file_data(buf,getFile[0],getFile[1],getFile[2]) # Put the file data in a buffer
 
-    if len(fileData) > 0: # But does the file ACTUALLY exist?
-        if len(fileName) > 0:
-            outpath = (f"{folder}{fileName}") # It's important that we allow ourselves to be passed a name for one file
-        else: # Otherwise, get the best file name
-            outpath = get_file_name(fileData,lookFolder,lookFile,lines,model,qbFile,True)
-            outpath = (f"{folder}{outpath}")
-        Path(outpath).parent.mkdir(parents=True,exist_ok=True)
-        with open(outpath, "wb") as outfile:
-            for byte in fileData:
-                outfile.write(struct.pack("B",byte))
-        return 0
-    else:
-        print(f"Invalid file {lookFolder}/{lookFile}: The file you are looking for does not exist!")
-        return -1
+    status = 0
+    found = []
+    matched = match_files(files,targets,lines)
+    if len(matched) == 0:
+        print(f"No files match {', '.join(str(target) for target in targets)}!")
+    for (lookFolder,lookFile) in matched:
+        if lookFolder > (folderCount - 1): # Does the folder exist?
+            print(f"Invalid file {lookFolder}/{lookFile}: There are only {folderCount} folders in this file!")
+            status = -1
+        elif lookFile >= len(files[lookFolder]): # Does the file exist?
+            print(f"Invalid file {lookFolder}/{lookFile}: There are only {len(files[lookFolder])} file(s) in this folder!")
+            status = -1
+        else:
+            found.append((lookFolder,lookFile))
+    if len(found) != 1:
+        fileName = "" # It's important that we allow ourselves to be passed a name for one file, but only one
+
+    results = ordered_map(lambda entry: unpack_entry(buf,folder,entry[0],entry[1],files[entry[0]][entry[1]],lines,model,qbFile,srcFd,noFolder,fileName),found,jobs)
+    for ((lookFolder,lookFile),result) in zip(found,results):
+        if result is None: # But does the file ACTUALLY exist?
+            print(f"Invalid file {lookFolder}/{lookFile}: The file you are looking for does not exist!")
+            status = -1
+    if len(found) == 0:
+        status = -1
+    return status
 
-def insert_file(buf, input, output, repFolder, repFile, model=False, compress=True):
+def extract_file(buf, folder, lookFolder, lookFile, model=False, useFilelist=True, qbFile=False, fileName="", srcFd=None):
+    return extract_files(buf,folder,[(lookFolder,lookFile)],model,useFilelist,qbFile,fileName,srcFd)
+
+def get_record_offset(buf, folder, file, effModel=False): # Where a file's entry lives in the header
+    if effModel:
+        return 0x04+(folder*0x10)+(file*0x04) # List of sizes
+    fileOffset = ru32(buf, 0x10+(folder*0x10))+(file*0x10)
+    if file == 0: # Same fix as parse_header(), so we replace the file that would have been extracted
+        if folder == 12 and ru32(buf,fileOffset) == 0x29D2000:
+            fileOffset = ru32(buf,0x10+(0x10*27))
+        elif folder == 27 and ru32(buf,fileOffset) == 0x52A800:
+            fileOffset = ru32(buf,0x10+(0x10*12))
+    return fileOffset
+
+def parse_insert_list(infile, lines=[]): # Read a list of replacements in the same format as filelist.txt
+    replacements = [] # [Folder, file, path]
+    with open(infile) as insert_list:
+        for line in insert_list.read().splitlines():
+            if len(line.strip()) > 0:
+                (filePos,fileName) = (line.split(":",1)+[""])[0:2]
+                fileName = Path(infile).parent/fileName.strip().strip("\"") # Relative to the list itself
+                if len(lines) > 0 and lines.find(filePos.strip()) is not None: # We can go by name as well as by number
+                    (folder,file) = lines.find(filePos.strip())
+                else:
+                    try:
+                        (folder,file) = [int(number) for number in filePos.split("/")]
+                    except ValueError: # Not a number, and not a name we know
+                        print(f"Invalid file {filePos.strip()}: It is neither a folder/file number nor a name in the file list!")
+                        return -1
+                replacements.append([int(folder),int(file),fileName])
+    return replacements
+
+@contextlib.contextmanager
+def open_temp_output(output): # Write to output.tmp, and don't leave it behind if anything goes wrong
+    try:
+        with open(f"{output}.tmp", "wb") as output_file:
+            yield output_file
+    except BaseException:
+        Path(f"{output}.tmp").unlink(missing_ok=True)
+        raise
+
+def insert_files(buf, replacements, output, model=False, compress=True, jobs=1, cache=None, packed=None, level="default"): # Replace any number of [folder, file, path] in one pass. packed can hold each replacement's (data, checksum, compressed) if we already have it
     effModel = False
     if model and ru32(buf,0x08) != 0x20031205: # 9/0 (game/eff/eff.bin) is a unique case
         effModel = True
         compress = False
+    folderCount = ru32(buf,0)
+    files = parse_header(buf,folderCount,effModel)
 
+    records = [] # [Header position, data offset, stored size] for every file, replaced or not
     if effModel:
-        folderCount = ru32(buf,0)
-        fileOffset = 0x04
-        dataOffset = fileOffset+(0x10*folderCount)
-        for i in range(repFolder*4+repFile-1): # Once again: it is a series of file sizes
-            dataOffset += ru32(fileOffset)
-            fileOffset += 0x04
-        fileSize = ru32(buf, fileOffset)
-        afterBuffer = buf[dataOffset+fileSize::] # Buffer for everything after the original file
+        for i in range(folderCount):
+            for j in range(len(files[i])):
+                records.append([0x04+(i*0x10)+(j*0x04),files[i][j][0],files[i][j][1]])
+        headerLength = 0x04+(folderCount*0x10)
+    else:
+        headerLength = 0x10+(folderCount*0x10)
+        for i in range(folderCount):
+            (fileOffset,fileCount) = struct.unpack_from("<II",buf,0x10+(0x10*i))
+            for j in range(fileCount):
+                records.append([fileOffset+(0x10*j),ru32(buf,fileOffset+(0x10*j)),ru32(buf,fileOffset+(0x10*j)+4)])
+            headerLength = max(headerLength,fileOffset+(0x10*fileCount))
+        headerLength += get_align_difference(headerLength)
+
+    recordLookup = {record[0]: record for record in records}
+    used = {} # How many files use each piece of data. Deduplicated BINs share it
+    for (recordOffset,dataOffset,fileSize) in records:
+        if fileSize > 0:
+            used[dataOffset] = used.get(dataOffset,0)+1
+    splices = [] # [Data offset, old stored size, folder, file, header position, path, replacement number]
+    for (k,(repFolder,repFile,input)) in enumerate(replacements):
+        if repFolder >= folderCount or repFile >= len(files[repFolder]):
+            print(f"Invalid file {repFolder}/{repFile}: There is no such file in this BIN!")
+            return -1
+        if packed is None and not Path(input).is_file(): # Better to find out before we've written anything
+            print(f"Invalid file {input}: The file to insert as {repFolder}/{repFile} does not exist!")
+            return -1
+        record = recordLookup[get_record_offset(buf,repFolder,repFile,effModel)]
+        if not effModel and used.get(record[1],0) > 1: # Other files still need the old data, so the new data goes in right after it
+            splices.append([record[1]+record[2]+get_align_difference(record[2]),0,repFolder,repFile,record[0],input,k])
+        else:
+            splices.append([record[1],record[2],repFolder,repFile,record[0],input,k])
+    splices.sort(key=lambda a: (a[0],a[1])) # One sorted pass through the data. Pure insertions go before a file replaced at the same spot
+    if len(set(splice[4] for splice in splices)) != len(splices):
+        print(f"The same file is being replaced more than once!")
+        return -1
+
+    if packed is not None:
+        results = [packed[splice[6]] for splice in splices]
     else:
-        fileOffset = ru32(buf, 0x10+(repFolder*0x10)) # We just need the offset and size of the file we're replacing
-        fileOffset += repFile*0x10
-        dataOffset = ru32(buf, fileOffset)
-        fileSize = ru32(buf, fileOffset+4)
-        fileSizeRounded = fileSize + get_align_difference(fileSize)
-        afterBuffer = buf[dataOffset+fileSizeRounded::] # Buffer for everything after the original file
-
-    newBuffer = buf[0:dataOffset] # Buffer for everything before the original file
-    (fileSize,checksum) = append_file(Path(input),newBuffer,repFolder,compress,effModel) # Append the new file to the first buffer
-    newBuffer.extend(afterBuffer) # And stick the second buffer back on afterward
-    modify_header(newBuffer,repFolder,repFile,fileSize,compress,checksum,effModel) # Finally, adjust the header
-
-    with open(output, "wb") as output_file:
-        for byte in newBuffer:
-            output_file.write(struct.pack("B",byte))
+        results = ordered_map(lambda splice: read_packed_file(splice[5],splice[2],compress,effModel,cache,level),splices,jobs)
+    newHeader = bytearray(buf[0:headerLength])
+    ends = [] # Where each replaced file ended, and how far everything from there on moves
+    differences = []
+    newOffsets = {} # Header position to where the replacement ended up
+    difference = 0
+    with open_temp_output(output) as output_file: # The output might be the input, so don't touch it until we're done
+        output_file = track_output(output_file)
+        output_file.seek(headerLength) # The header goes in last
+        position = headerLength
+        for (splice,(fileData,checksum,compressed)) in zip(splices,results):
+            (dataOffset,oldSize,repFolder,repFile,recordOffset,input,k) = splice
+            output_file.write(buf[position:dataOffset]) # Everything since the last replacement
+            newOffsets[recordOffset] = output_file.tell()
+            output_file.write(fileData)
+            newSize = len(fileData)
+            if not effModel: # PS2 games would take a bullet to be 0x800-aligned
+                output_file.write(bytes(get_align_difference(newSize)))
+                oldSize += get_align_difference(oldSize)
+                newSize += get_align_difference(newSize)
+            position = dataOffset+oldSize
+            difference += newSize-oldSize
+            ends.append(position)
+            differences.append(difference)
+            if effModel:
+                newHeader[recordOffset:recordOffset+4] = wu32(len(fileData)) # The size is all there is
+            else:
+                newHeader[recordOffset+4:recordOffset+8] = wu32(len(fileData))
+                newHeader[recordOffset+8:recordOffset+10] = wu16(compressed*0x2000) # Set compression flag
+                newHeader[recordOffset+10:recordOffset+11] = wu08(checksum)
+        output_file.write(buf[position:]) # Everything after the last replacement
+        if not effModel: # Move every file that comes after a replacement
+            for (recordOffset,dataOffset,fileSize) in records:
+                k = bisect.bisect_right(ends,dataOffset)
+                if k > 0:
+                    newHeader[recordOffset:recordOffset+4] = wu32(dataOffset+differences[k-1])
+            for (recordOffset,newOffset) in newOffsets.items(): # The replacements themselves are wherever we put them
+                newHeader[recordOffset:recordOffset+4] = wu32(newOffset)
+            if folderCount > 27 and ru32(buf,0x14+(0x10*12)) > 0 and ru32(buf,0x14+(0x10*27)) > 0: # parse_header() only spots the vanilla 12/27 swap at the vanilla offsets
+                swapped = [get_record_offset(buf,12,0),get_record_offset(buf,27,0)]
+                normal = [ru32(buf,0x10+(0x10*12)),ru32(buf,0x10+(0x10*27))]
+                if swapped != normal and any(ru32(newHeader,offset) != ru32(buf,offset) for offset in normal): # So once either has moved, put them back where they belong
+                    swappedRecords = [bytes(newHeader[offset:offset+0x10]) for offset in swapped]
+                    for (offset,record) in zip(normal,swappedRecords):
+                        newHeader[offset:offset+0x10] = record
+        output_file.seek(0)
+        output_file.write(newHeader)
+    os.replace(f"{output}.tmp",output)
+    return 0
+
+def patch_files(path, replacements, model=False, compress=True, jobs=1, cache=None, level="default"): # Overwrite files inside the BIN itself when they still fit
+    buf = map_file(path)
+    effModel = False
+    if model and ru32(buf,0x08) != 0x20031205: # 9/0 (game/eff/eff.bin) is a unique case
+        effModel = True
+        compress = False
+    folderCount = ru32(buf,0)
+    files = parse_header(buf,folderCount,effModel)
+    for (repFolder,repFile,input) in replacements:
+        if repFolder >= folderCount or repFile >= len(files[repFolder]):
+            print(f"Invalid file {repFolder}/{repFile}: There is no such file in this BIN!")
+            return -1
+        if not Path(input).is_file():
+            print(f"Invalid file {input}: The file to insert as {repFolder}/{repFile} does not exist!")
+            return -1
+    used = {} # How many files use each data offset. Shared data can't be patched for just one of them
+    for folder in files:
+        for getFile in folder:
+            if getFile[1] > 0: # Empty files sit at the same offset as whatever comes next, without sharing anything
+                used[getFile[0]] = used.get(getFile[0],0)+1
+
+    packed = list(ordered_map(lambda replacement: read_packed_file(replacement[2],replacement[0],compress,effModel,cache,level),replacements,jobs))
+    patches = [] # [Header position, data offset, slot size, new data, checksum, folder]
+    fits = True
+    for ((repFolder,repFile,input),(fileData,checksum,compressed)) in zip(replacements,packed):
+        recordOffset = get_record_offset(buf,repFolder,repFile,effModel)
+        (dataOffset,fileSize) = (files[repFolder][repFile][0],files[repFolder][repFile][1])
+        if effModel: # Sizes are all effModel has, so it has to be an exact fit
+            slotSize = fileSize
+            fits = fits and len(fileData) == slotSize
+        else:
+            slotSize = fileSize+get_align_difference(fileSize)
+            fits = fits and len(fileData) <= slotSize
+        fits = fits and used.get(dataOffset,0) <= 1
+        patches.append([recordOffset,dataOffset,slotSize,fileData,checksum,compressed])
+    if len(set(patch[0] for patch in patches)) != len(patches):
+        print(f"The same file is being replaced more than once!")
+        return -1
+
+    if not fits: # Something has to move, so splice everything in one go
+        print(f"Not every file fits in its original space. Rebuilding the rest of the BIN instead...")
+        status = insert_files(buf,replacements,f"{path}.new",model,compress,jobs,cache,packed,level)
+        buf.release() # Windows won't replace a file that's still mapped
+        if status == 0:
+            os.replace(f"{path}.new",path)
+        return status
+    buf.release() # We're only writing from here on
+    with open(path, "r+b") as bin_file:
+        bin_file = track_output(bin_file)
+        for (recordOffset,dataOffset,slotSize,fileData,checksum,compressed) in patches:
+            bin_file.seek(dataOffset)
+            bin_file.write(fileData)
+            bin_file.write(bytes(slotSize-len(fileData))) # Clear out what's left of the old file
+            if effModel:
+                continue # Same size, so the header doesn't change
+            bin_file.seek(recordOffset+4)
+            bin_file.write(wu32(len(fileData)))
+            bin_file.write(wu16(compressed*0x2000)) # Set compression flag
+            bin_file.write(wu08(checksum))
+    return 0
+
+def insert_file(buf, input, output, repFolder, repFile, model=False, compress=True, level="default"):
+    return insert_files(buf,[[repFolder,repFile,Path(input)]],output,model,compress,1,None,None,level)
+
+def get_data_regions(buf, model=False): # Every distinct piece of file data as [offset, stored size, [(folder, file, checksum), ...]], in the order it sits in the BIN
+    effModel = model and ru32(buf,0x08) != 0x20031205 # 9/0 (game/eff/eff.bin) is a unique case
+    files = parse_header(buf,ru32(buf,0),effModel)
+    regions = {}
+    for i in range(len(files)):
+        for j in range(len(files[i])):
+            (dataOffset,fileSize,compressed,checksum) = files[i][j][0:4]
+            if fileSize > 0: # Empty files don't take up any space
+                regions.setdefault(dataOffset,[dataOffset,fileSize,[]])[2].append((i,j,checksum))
+    return [regions[dataOffset] for dataOffset in sorted(regions)]
+
+class PatchWriter: # Collects patch operations, merging neighbours so an unchanged stretch of the BIN is a single copy
+    def __init__(self):
+        self.ops = [] # [Operation, old offset, length, [data views]]
+
+    def copy(self, offset, length):
+        if length == 0:
+            return
+        if self.ops and self.ops[-1][0] == PATCH_COPY and self.ops[-1][1]+self.ops[-1][2] == offset:
+            self.ops[-1][2] += length
+        else:
+            self.ops.append([PATCH_COPY,offset,length,None])
+
+    def data(self, view):
+        if len(view) == 0:
+            return
+        if self.ops and self.ops[-1][0] == PATCH_DATA:
+            self.ops[-1][2] += len(view)
+            self.ops[-1][3].append(view)
+        else:
+            self.ops.append([PATCH_DATA,0,len(view),[view]])
+
+    def raw(self, view): # Bytes that only exist in the new BIN. Trailing padding is stored as a length instead
+        stripped = len(bytes(view).rstrip(b"\x00"))
+        self.data(view[0:stripped])
+        if stripped < len(view):
+            if self.ops and self.ops[-1][0] == PATCH_ZERO:
+                self.ops[-1][2] += len(view)-stripped
+            else:
+                self.ops.append([PATCH_ZERO,0,len(view)-stripped,None])
+
+    def write(self, output, header): # Returns the size of the patch
+        with open(output, "wb") as patch_file:
+            patch_file = track_output(patch_file)
+            patch_file.write(header)
+            for (op,offset,length,views) in self.ops:
+                patch_file.write(PATCH_OP.pack(op,offset,length))
+                if op == PATCH_DATA:
+                    for view in views:
+                        patch_file.write(view)
+            patch_file.write(PATCH_OP.pack(PATCH_END,0,0))
+            return patch_file.tell()
+
+def diff_bins(oldBuf, newBuf, output, model=False): # Write a patch that turns oldBuf into newBuf, holding only the files that changed
+    oldRegions = get_data_regions(oldBuf,model)
+    newRegions = get_data_regions(newBuf,model)
+    oldByEntry = {} # (folder, file) to old offset
+    oldByContents = {} # (stored size, checksum) to old offsets, for files that moved to a different number
+    for (dataOffset,fileSize,entries) in oldRegions:
+        for (i,j,checksum) in entries:
+            oldByEntry[(i,j)] = [dataOffset,fileSize,checksum]
+            oldByContents.setdefault((fileSize,checksum),[]).append(dataOffset)
+    oldHeaderLength = oldRegions[0][0] if oldRegions else len(oldBuf)
+
+    def find_unchanged(fileSize, entries): # An old offset holding exactly this data, or None. Checksums rule out most candidates without comparing any bytes
+        candidates = []
+        for (i,j,checksum) in entries:
+            old = oldByEntry.get((i,j))
+            if old is not None and old[1] == fileSize and old[2] == checksum:
+                candidates.append(old[0])
+        candidates.extend(oldByContents.get((fileSize,entries[0][2]),[]))
+        for oldOffset in candidates:
+            if oldBuf[oldOffset:oldOffset+fileSize] == newBuf[dataOffset:dataOffset+fileSize]:
+                return oldOffset
+        return None
+
+    writer = PatchWriter()
+    changed = 0 # Files that aren't what they were
+    stored = 0 # Files whose data isn't anywhere in the old BIN
+    total = 0
+    position = 0
+    newHeaderLength = newRegions[0][0] if newRegions else len(newBuf)
+    if newHeaderLength == oldHeaderLength and newBuf[0:newHeaderLength] == oldBuf[0:oldHeaderLength]: # Same file sizes everywhere
+        writer.copy(0,newHeaderLength)
+        position = newHeaderLength
+    for (k,(dataOffset,fileSize,entries)) in enumerate(newRegions):
+        total += len(entries)
+        if dataOffset < position: # Overlapping data. Whatever's left of it comes along with what came before
+            continue
+        writer.raw(newBuf[position:dataOffset]) # The header, or whatever sits between files
+        end = newRegions[k+1][0] if k+1 < len(newRegions) else len(newBuf)
+        gap = newBuf[dataOffset+fileSize:max(end,dataOffset+fileSize)]
+        oldOffset = find_unchanged(fileSize,entries)
+        for (i,j,checksum) in entries: # Same data as before, wherever it's kept now?
+            old = oldByEntry.get((i,j))
+            if oldOffset is None or old is None or old[1:3] != [fileSize,checksum] or (old[0] != oldOffset and oldBuf[old[0]:old[0]+fileSize] != oldBuf[oldOffset:oldOffset+fileSize]):
+                changed += 1
+        if oldOffset is None:
+            writer.data(newBuf[dataOffset:dataOffset+fileSize])
+            stored += len(entries)
+            position = dataOffset+fileSize
+        elif oldBuf[oldOffset+fileSize:oldOffset+fileSize+len(gap)] == gap: # The padding is the same too, so it can come along
+            writer.copy(oldOffset,fileSize+len(gap))
+            position = dataOffset+fileSize+len(gap)
+        else:
+            writer.copy(oldOffset,fileSize)
+            position = dataOffset+fileSize
+    writer.raw(newBuf[position:])
+
+    header = PATCH_HEADER.pack(PATCH_MAGIC,1,len(oldBuf),oldHeaderLength,hashlib.sha1(oldBuf[0:oldHeaderLength]).digest(),len(newBuf),hashlib.sha1(newBuf).digest())
+    patchSize = writer.write(output,header)
+    print(f"{changed} of {total} file(s) changed, {stored} of them with new data. The patch is {patchSize} bytes")
+    return 0
+
+def apply_patch(buf, patchPath, output): # Rebuild the new BIN from the old one and a patch, in one pass through both
+    patch = map_file(patchPath)
+    if len(patch) < PATCH_HEADER.size or bytes(patch[0:8]) != PATCH_MAGIC:
+        print(f"{patchPath} is not a BIN patch!")
+        return -1
+    (magic,version,oldSize,oldHeaderLength,oldHash,newSize,newHash) = PATCH_HEADER.unpack_from(patch,0)
+    if version != 1:
+        print(f"{patchPath} was made by a newer version of this script!")
+        return -1
+    if len(buf) != oldSize or hashlib.sha1(buf[0:oldHeaderLength]).digest() != oldHash:
+        print(f"This patch was made for a different BIN!")
+        return -1
+    hasher = hashlib.sha1() # To be sure we got exactly the BIN the patch was made from
+    written = 0
+    position = PATCH_HEADER.size
+    with open(f"{output}.tmp", "wb") as output_file: # The output might be the input, so don't touch it until we're done
+        output_file = track_output(output_file)
+        while True:
+            (op,offset,length) = PATCH_OP.unpack_from(patch,position)
+            position += PATCH_OP.size
+            if op == PATCH_END:
+                break
+            if op == PATCH_COPY:
+                data = buf[offset:offset+length]
+            elif op == PATCH_DATA:
+                data = patch[position:position+length]
+                position += length
+            else:
+                data = bytes(length)
+            hasher.update(data)
+            output_file.write(data)
+            written += length
+    if written != newSize or hasher.digest() != newHash:
+        os.remove(f"{output}.tmp")
+        print(f"The patched BIN doesn't match the one the patch was made from!")
+        return -1
+    os.replace(f"{output}.tmp",output)
     return 0
 
-def unpack(buf, folder, model=False, useFilelist=True, qbFile=False):
+def ordered_map(func, items, jobs=1): # Run func over items, handing back results in the original order
+    if jobs <= 1:
+        for item in items:
+            yield func(item)
+    else: # zlib and file writes release the GIL, so threads are enough
+        from concurrent.futures import ThreadPoolExecutor # Slow to import, and most runs don't need it
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            pending = deque()
+            for item in items:
+                pending.append(pool.submit(func,item))
+                if len(pending) >= jobs*4: # Don't let finished files pile up in memory
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+def unpack_entry(buf, folder, i, j, getFile, lines=[], model=False, qbFile=False, srcFd=None, noFolder=False, fileName="", recursive=False, digest=False): # Extract a single file to wherever it belongs. Returns [path, size, hash, stored size] or None
+    reader = EntryReader(buf,getFile[0],getFile[1],getFile[2])
+    chunks = iter_file_data(buf,getFile[0],getFile[1],getFile[2],0x40000,reader) # Decompress a piece at a time
+    head = next(chunks,None)
+    if head is not None and len(head) > 0: # Does the file exist?
+        if len(fileName) > 0:
+            outpath = fileName
+        else:
+            outpath = get_file_name(head,i,j,lines,model,qbFile,noFolder) # The first piece is enough to get the best file name
+        Path(f"{folder}{outpath}").parent.mkdir(parents=True,exist_ok=True) # Make the folder required
+        hasher = None
+        if digest: # Only worth the trouble if someone's keeping a manifest
+            hasher = hashlib.sha1()
+        fileSize = 0
+        if getFile[2] == 0 and srcFd is not None: # Uncompressed files can skip the trip through Python
+            write_file_data(f"{folder}{outpath}",head,srcFd,getFile[0])
+            fileSize = len(head)
+            if hasher is not None:
+                hasher.update(head)
+        else:
+            with open(f"{folder}{outpath}", "wb") as outfile:
+                outfile = track_output(outfile)
+                for chunk in itertools.chain([head],chunks):
+                    outfile.write(chunk)
+                    fileSize += len(chunk)
+                    if hasher is not None:
+                        hasher.update(chunk)
+        if recursive: # Model files inside BIN files get unpacked next to themselves
+            fileSize = getFile[1]
+            if getFile[2] == 1:
+                fileSize = ru32(buf,getFile[0]) # The real size comes before the compressed data
+            if detect_container(head,fileSize):
+                if getFile[2] == 1:
+                    nestedData = get_file_data(buf,getFile[0],getFile[1],getFile[2])
+                else:
+                    nestedData = head # Already a view of the whole file
+                unpack(nestedData,f"{folder}{Path(outpath).with_suffix('')}/",True,False,qbFile,1,None,True,False)
+        if hasher is not None:
+            return [outpath,fileSize,hasher.hexdigest(),reader.get_stored_size()]
+        return [outpath,fileSize,None,reader.get_stored_size()]
+    return None
+
+def unpack(buf, folder, model=False, useFilelist=True, qbFile=False, jobs=1, srcFd=None, recursive=False, verbose=True, binPath=None): # With binPath, a manifest is written for incremental rebuilds
     folderCount = ru32(buf,0x00) # Number of folders
     effModel = False
     if model and ru32(buf,0x08) != 0x20031205: # 9/0 (game/eff/eff.bin) is a unique case
@@ -354,71 +1135,82 @@ def unpack(buf, folder, model=False, useFilelist=True, qbFile=False):
 
     files = parse_header(buf,folderCount,effModel) # Set up our directory structure
 
-    getFile = []
-    for i in range(folderCount):
-        print(f"Folder {i}: {len(files[i])} file(s)")
+    entries = [(i,j) for i in range(folderCount) for j in range(len(files[i]))] # Every file, in header order
+    results = ordered_map(lambda entry: unpack_entry(buf,folder,entry[0],entry[1],files[entry[0]][entry[1]],lines,model,qbFile,srcFd,False,"",recursive,binPath is not None),entries,jobs)
+    manifest = None
+    if binPath is not None:
+        manifest = BuildManifest(binPath,effModel)
+    for i in range(folderCount): # Results come back in order, so progress reports stay in order too
+        if verbose:
+            print(f"Folder {i}: {len(files[i])} file(s)")
         for j in range(len(files[i])):
-            getFile = files[i][j]
-            fileData = get_file_data(buf,getFile[0],getFile[1],getFile[2]) # Put the file data in a buffer
-            if len(fileData) > 0: # Does the file exist?
-                outpath = get_file_name(fileData,i,j,lines,model,qbFile) # Get the best file name
-                Path(f"{folder}{outpath}").parent.mkdir(parents=True,exist_ok=True) # Make the folder required
-                with open(f"{folder}{outpath}", "wb") as outfile:
-                    for byte in fileData:
-                        outfile.write(struct.pack("B",byte))
-            if not effModel: # Progress report for folders with over 500 files
+            result = next(results)
+            if manifest is not None and result is not None:
+                (outpath,fileSize,fileHash,storedSize) = result
+                (offset,headerSize,compressed,checksum) = files[i][j]
+                if storedSize is not None and storedSize != headerSize: # The English patch messed up the sizes, so the whole stream gets copied and the checksum has to match it
+                    checksum = get_file_checksum(buf[offset:offset+storedSize])
+                manifest.add(outpath,fileSize,os.stat(f"{folder}{outpath}").st_mtime_ns,fileHash,offset,storedSize,compressed,checksum,headerSize,get_compression_settings()) # Whatever made the BIN, copying it as it is counts as the default
+            if verbose and not effModel: # Progress report for folders with over 500 files
                 if j >= 499 and (j+1)%100 == 0: # Just so the user knows we're not stuck
                     print(f"Please wait. {j+1} files complete...", end="\r", flush=True)
                 if j > 499 and j == len(files[i]) - 1:
                     print(f"Please wait. {j+1} files complete.  ")
     if effModel:
+        Path(folder).mkdir(parents=True,exist_ok=True) # Nested ones won't have made it yet if every file is empty
         with open(f"{folder}effModel", "wb") as eff_file: # We will create an empty file to indicate this
             eff_file.close()
+    if manifest is not None:
+        manifest.save(folder)
     return 0
 
-def rebuild(folder,output,model=False,compress=True,useFilelist=True):
-    databuffer = bytearray(0) # This will store file data
+def get_header_length(headerarray, effModel=False): # Size of the header rebuild_header() will produce, padding included
+    if effModel:
+        return 0x04+(len(headerarray)*0x10)
+    headerLength = 0x10+(len(headerarray)*0x10)
+    for folder in headerarray:
+        headerLength += 0x10*len(folder)
+    return headerLength+get_align_difference(headerLength)
+
+def rebuild(folder,output,model=False,compress=True,useFilelist=True,jobs=1,cache=None,incremental=False,dedupe=False,dedupeReport="",level="default"):
     headerarray = []
     effModel = False
     if model and (Path(f"{folder}/effModel").exists() or not Path(f"{folder}/filelist.id").exists()): # 9/0 (game/eff/eff.bin) is a unique case
         effModel = True
         compress = False
+    if dedupe and effModel: # Files are found by adding up sizes, so two of them can't share data
+        print(f"effModel BINs can't share data between files. Storing every file separately...")
+        dedupe = False
 
     lines = [] # Set up our filelist
     if useFilelist:
         lines = parse_filelist("./filelist.txt")
 
+    folders = [] # First pass: work out the header layout. Each entry is [folder, [[folder, file, path], ...], file count]
     if useFilelist:
         filePath = Path()
         for i in range(len(lines)):
+            folderFiles = []
             j = -1
-            for j in range(len(lines[i])):
-                curFile = lines[i][j]
-                filePath = Path(f"{folder}/{curFile[2]}/{curFile[3]}") # Get path of current file
-                while len(headerarray) <= int(curFile[0]): # Add to arrays if necessary
+            for j in range(lines.file_count(i)):
+                if lines.get_path(i,j) is None:
+                    continue
+                filePath = Path(f"{folder}/{lines.get_path(i,j)}") # Get path of current file
+                while len(headerarray) <= i: # Add to arrays if necessary
                     headerarray.append([])
-                while len(headerarray[int(curFile[0])]) <= int(curFile[1]):
-                    headerarray[int(curFile[0])].append([])
+                while len(headerarray[i]) <= j:
+                    headerarray[i].append([])
                 if filePath.exists():
-                    (fileSize,checksum) = append_file(filePath,databuffer,int(curFile[0]),compress,effModel) # Append file to data buffer
-                    getFile = headerarray[int(curFile[0])][int(curFile[1])]
-                    getFile.append(0) # We don't use file offsets in the header reassembly method
-                    getFile.append(fileSize)
-                    getFile.append(int(compress))
-                    getFile.append(checksum)
+                    folderFiles.append([i,j,filePath])
                 else:
                     print(f"File {filePath} does not exist! Skipping...")
-                if not effModel: # Progress report for folders with over 500 files
-                    if j >= 499 and (j+1)%100 == 0: # Just so the user knows we're not stuck
-                        print(f"Please wait. {j+1} files complete...", end="\r", flush=True)
-                    if j > 499 and j == len(lines[i]) - 1:
-                        print(f"Please wait. {j+1} files complete.  ")
-            print(f"Folder {i} scanned: {j+1} file(s)")
+            folders.append([i,folderFiles,j+1])
     else:
         for i in sorted(Path(folder).iterdir(),key=lambda a: numsort(a.stem)): # Sort properly by number
             curFile = -1
             if i.is_dir() and not i.is_file() and i.stem.isnumeric(): # And we only want folders with numeric names
                 curFolder = int(i.stem)
+                folderFiles = []
                 while len(headerarray) <= curFolder: # Make sure the appropriate array exists!!
                     headerarray.append([])
                 for j in sorted(Path(i).iterdir(),key=lambda b: numsort(b.stem)): # Same for files
@@ -429,113 +1221,703 @@ def rebuild(folder,output,model=False,compress=True,useFilelist=True):
                             curFile = curFile+1
                         while len(headerarray[curFolder]) <= curFile:
                             headerarray[curFolder].append([])
-                        getFile = headerarray[curFolder][curFile]
-                        (fileSize,checksum) = append_file(j,databuffer,curFolder,compress,effModel) # Append file to data buffer
-                        getFile.append(0) # See above
-                        getFile.append(fileSize)
-                        getFile.append(int(compress))
-                        if effModel: # effModel doesn't know about this
-                            getFile.append(0)
-                        else:
-                            getFile.append(checksum)
-                            if curFile >= 499 and (curFile+1)%100 == 0: # Just so the user knows we're not stuck
-                                print(f"Please wait. {curFile+1} files complete...", end="\r", flush=True)
-                if curFile >= 499:
-                    print(f"Please wait. {curFile+1} files complete.  ")
-                print(f"Folder {curFolder} scanned: {curFile+1} file(s)")
-    
-    fileheader = rebuild_header(headerarray,effModel) # Build the header
+                        folderFiles.append([curFolder,curFile,j])
+                folders.append([curFolder,folderFiles,curFile+1])
+
+    previous = None
+    if incremental: # Unchanged files can come straight out of the last BIN
+        previous = BuildManifest.load(folder,effModel)
+        if previous is None:
+            print(f"No usable manifest in {folder}. Rebuilding everything...")
+    manifest = BuildManifest(output,effModel)
+    settings = get_compression_settings(level) # Files packed any other way can't be reused
+    reused = 0
+    claimed = set() # Payloads a job has already started packing
+    claimLock = threading.Lock()
+    stored = {} # Payload to [offset, stored size, checksum, [paths], compressed] once it's in the output
+    rawSectors = 0 # What the files would take up on the disc uncompressed
+    storedSectors = 0
+
+    def get_allowed_flags(curFolder): # Which compression flags a file in this folder may end up with
+        if effModel or (not compress and curFolder != 8): # pack_file() won't compress these whatever the level
+            return (0,)
+        if level == "auto" and curFolder != 8: # Left uncompressed if compressing doesn't save anything
+            return (0,1)
+        if compress or curFolder == 8:
+            return (1,)
+        return (0,)
+
+    def get_payload_key(curFolder, fileHash): # Files with the same contents are only stored the same way if they're packed the same way
+        return (fileHash,get_allowed_flags(curFolder))
+
+    def pack_entry(curFile): # Get a file's data as it will be stored, and what the manifest should say about it
+        filePath = curFile[2]
+        relPath = filePath.relative_to(folder).as_posix()
+        fileStat = filePath.stat()
+        if previous is not None:
+            result = previous.reuse(relPath,filePath,fileStat,get_allowed_flags(curFile[0]),settings)
+            if result is not None:
+                return result
+        with open(filePath, "rb") as input_file:
+            fileData = input_file.read()
+        fileHash = hashlib.sha1(fileData).hexdigest()
+        source = [relPath,fileStat.st_size,fileStat.st_mtime_ns,fileHash]
+        if dedupe:
+            key = get_payload_key(curFile[0],fileHash)
+            with claimLock:
+                duplicate = key in claimed
+                claimed.add(key)
+            if duplicate: # No point compressing it twice
+                return (None,None,None,source,False)
+        (fileData,checksum,compressed) = pack_file(fileData,curFile[0],compress,effModel,cache,level)
+        return (fileData,checksum,compressed,source,False)
+
+    headerLength = get_header_length(headerarray,effModel) # The header only depends on the file counts, so we can leave room for it
+    with open(f"{output}.tmp", "wb") as output_file: # The last BIN might be the output, and we could still be reading from it
+        output_file = track_output(output_file)
+        output_file.seek(headerLength)
+        for (curFolder,folderFiles,fileCount) in folders: # Second pass: stream every file straight to the output
+            results = ordered_map(pack_entry,folderFiles,jobs)
+            for k, (fileData,checksum,compressed,source,wasReused) in enumerate(results): # Results come back in order
+                reused += wasReused
+                rawSectors += get_sector_count(source[1])
+                key = get_payload_key(curFolder,source[3])
+                if dedupe and key in stored: # Already in the output, so just point at it
+                    (fileOffset,fileSize,checksum) = stored[key][0:3]
+                    compressed = stored[key][4]
+                    stored[key][3].append(source[0])
+                else:
+                    if fileData is None: # The copy a job did compress comes later in the BIN, so it isn't written yet
+                        (fileData,checksum,compressed) = read_packed_file(folderFiles[k][2],curFolder,compress,effModel,cache,level)
+                    fileOffset = output_file.tell()
+                    fileSize = len(fileData)
+                    storedSectors += get_sector_count(fileSize)
+                    output_file.write(fileData)
+                    if not effModel:
+                        output_file.write(bytes(get_align_difference(fileSize))) # PS2 games would take a bullet to be 0x800-aligned
+                    if dedupe:
+                        stored[key] = [fileOffset,fileSize,checksum,[source[0]],compressed]
+                manifest.add(*source,fileOffset,fileSize,compressed,checksum,fileSize,settings)
+                getFile = headerarray[folderFiles[k][0]][folderFiles[k][1]]
+                getFile.append(fileOffset) # Only used by the header when deduplicating
+                getFile.append(fileSize)
+                getFile.append(compressed)
+                if effModel: # effModel doesn't know about this
+                    getFile.append(0)
+                else:
+                    getFile.append(checksum)
+                    if k >= 499 and (k+1)%100 == 0: # Just so the user knows we're not stuck
+                        print(f"Please wait. {k+1} files complete...", end="\r", flush=True)
+            if not effModel and len(folderFiles) > 500:
+                print(f"Please wait. {len(folderFiles)} files complete.  ")
+            print(f"Folder {curFolder} scanned: {fileCount} file(s)")
+        if cache is not None:
+            cache.trim()
+            print(f"{cache.hits} file(s) from the cache, {cache.misses} compressed")
 
-    with open(output, "wb") as output_file:
-        output_file.write(fileheader) # Write the header and data
-        output_file.write(databuffer)
+        fileheader = rebuild_header(headerarray,effModel,dedupe) # Build the header
+        output_file.seek(0)
+        output_file.write(fileheader) # And put it in the space we left
         output_file.close()
+    if previous is not None:
+        previous.close()
+        print(f"Reused {reused} unchanged file(s) from the last build")
+    os.replace(f"{output}.tmp",output)
+    manifest.save(folder)
+    if not effModel: # Disc space and seek times are counted in sectors, so that's what matters
+        print(f"Files take up {storedSectors} sectors instead of {rawSectors} uncompressed, saving {rawSectors-storedSectors} ({(rawSectors-storedSectors)*0x800/0x100000:.1f} MB)")
+    if dedupe:
+        report_duplicates(stored,dedupeReport)
+    return 0
+
+def report_duplicates(stored, reportPath=""): # Sum up what deduplication saved, and optionally list every group of identical files
+    groups = []
+    for ((fileHash,allowed),(fileOffset,fileSize,checksum,paths,compressed)) in stored.items():
+        if len(paths) > 1:
+            groups.append({"hash": fileHash, "offset": fileOffset, "storedSize": fileSize, "saved": (len(paths)-1)*(fileSize+get_align_difference(fileSize)), "files": paths})
+    groups.sort(key=lambda group: -group["saved"])
+    saved = sum(group["saved"] for group in groups)
+    duplicates = sum(len(group["files"])-1 for group in groups)
+    print(f"Deduplicated {duplicates} file(s) in {len(groups)} group(s), saving {saved} bytes")
+    for group in groups[0:5]: # The biggest savings, so it's obvious where they came from
+        print(f"  {len(group['files'])} copies of {group['files'][0]}: {group['saved']} bytes")
+    if reportPath:
+        with open(reportPath, "w") as report_file:
+            json.dump({"duplicates": duplicates, "saved": saved, "groups": groups},report_file,indent=4)
     return 0
 
-parser = argparse.ArgumentParser(description='Phantom Blood PS2 BIN Extractor/Rebuilder') # QuickBMS doesn't know what these are
-parser.add_argument("inpath", help="File Input (BIN/Folder)") # But I do
-parser.add_argument("-o", "--outpath", type=str, default="", help="Optional. The name used for the output folder or file.")
-parser.add_argument("-nc", "--nocompress", action="store_true", help="Optional. BIN output only. Disables ZLib compression on files within the BIN.") # For if you want the chunkiest possible game directory
-parser.add_argument("-m", "--model", action="store_true", help="Optional. Indicates a BIN file or folder is formatted as a model file.") # There are BIN files inside BIN files. It gets weirder
-parser.add_argument("-qb", "--qbextensions", action="store_true", help="Optional. BIN input only. Gives PGM and DAT extensions in place of TEX/TX2 and LXE.") # For compatibility and nostalgia
-parser.add_argument("-nl", "--nolist", action="store_true", help="Optional. Ignores the provided file list, if available.") # Ditto
-parser.add_argument("-fo", "--folder", type=int, default="-1", help="Optional. Extracts files from the desired folder, or specifies insertion folder.") # Ditto
-parser.add_argument("-fi", "--file", type=int, default="-1", help="Optional. Extracts the desired file from a folder, or specifies insertion file.") # Ditto
-parser.add_argument("-i", "--insert", type=str, default="", help="Optional. Indicates the file to insert at the provided folder and file number.") # Ditto
-
-args = parser.parse_args()
-
-compress = not args.nocompress # For convenience
-filelist = not args.nolist
-if args.model or not Path("./filelist.txt").is_file(): # If we don't have a file list, we don't have it
-    filelist = False # And if we're handling the file as a model we can't use the list anyway
-if args.folder == -1: # Let's not look for a file without a folder to look in
-    args.file = -1
-if args.file == -1 or not (Path(args.insert).is_file() and not Path(args.insert).is_dir()):
-    args.insert = False # And we can't insert anything if we don't know where to look
-
-if Path(args.inpath).is_file() and not Path(args.inpath).is_dir(): # BIN input is assumed
-    with open(args.inpath, "rb") as input_file:
-        input_buffer = bytearray( input_file.read() )
-
-        outpath = "./"
-        if len(args.outpath) > 0: # Outpath takes priority!!
-            outpath += args.outpath
-        elif args.insert: # After that is insertion, since that is based on an existing file
-            outpath = (f"{Path(args.inpath).parent}/{Path(args.inpath).stem}_modified{Path(args.inpath).suffix}")
-        elif not args.folder == -1: # Then check for individual folder/file...
-            if args.file == -1: # We can get away with just sending an individual file to the input directory
-                if args.model: # If we have a model file, we should specify it.
-                    outpath = (f"{Path(outpath).parent}/model-{Path(args.inpath).stem}_{args.folder}")
+def classify_path(path): # "bin" or "effModel" for a BIN, "folder" for an unpacked one, or "" for anything else
+    path = Path(path)
+    if path.is_file():
+        with open(path, "rb") as input_file:
+            head = input_file.read(0x10000) # Plenty for either kind of header
+        return detect_container(head,path.stat().st_size)
+    if path.is_dir():
+        if (path/"effModel").exists() or (path/"manifest.json").exists(): # Left behind by unpack()
+            return "folder"
+        if any(child.is_dir() and child.name.isnumeric() for child in path.iterdir()): # Unpacked without the file list
+            return "folder"
+    return ""
+
+def find_batch_items(inpath, mode="auto"): # [kind, path, relative path] for every BIN and unpacked folder in a directory or matching a glob
+    kinds = {"auto": ("bin","effModel","folder"), "unpack": ("bin","effModel"), "rebuild": ("folder",)}[mode]
+    items = []
+    if Path(inpath).is_dir():
+        root = Path(inpath)
+        for (current,dirnames,filenames) in os.walk(root):
+            current = Path(current)
+            for dirname in sorted(dirnames,key=numsort):
+                if classify_path(current/dirname) == "folder":
+                    if "folder" in kinds:
+                        items.append(["folder",current/dirname,(current/dirname).relative_to(root)])
+                    dirnames.remove(dirname) # What's inside an unpacked BIN belongs to it
+            for filename in sorted(filenames):
+                kind = classify_path(current/filename)
+                if kind in kinds:
+                    items.append([kind,current/filename,(current/filename).relative_to(root)])
+    else:
+        parts = Path(inpath).parts
+        fixed = 0
+        while fixed < len(parts)-1 and not any(char in parts[fixed] for char in "*?["): # Everything before the first wildcard is common to every match
+            fixed += 1
+        root = Path(*parts[0:fixed])
+        for match in sorted(glob.glob(inpath,recursive=True)):
+            kind = classify_path(match)
+            if kind in kinds:
+                items.append([kind,Path(match),Path(match).relative_to(root)]) # So same-named BINs in different folders stay apart
+    return items
+
+def matches_filelist(buf, lines): # Is this the BIN the file list describes, rather than a model?
+    return len(lines) > 0 and ru32(buf,0x08) == 0x20031205 and ru32(buf,0x00) == len(lines)
+
+def count_files(path, effModel=False): # How many files a BIN holds
+    buf = map_file(path)
+    if len(buf) < 0x04:
+        return 0
+    files = parse_header(buf,ru32(buf,0x00),effModel)
+    if effModel: # Every folder has four sizes, used or not
+        return sum(1 for folder in files for getFile in folder if getFile[1] > 0)
+    return sum(len(folder) for folder in files)
+
+def get_folder_size(folder):
+    return sum(filePath.stat().st_size for filePath in Path(folder).rglob("*") if filePath.is_file())
+
+def init_batch_worker(loaded): # Hand a worker the file list the batch already parsed
+    LOADED_FILELISTS.update(loaded)
+
+def run_batch_item(item): # Unpack or rebuild one archive. Runs in a worker process, so it reports back instead of printing
+    (kind,path,output,compress,useFilelist,level) = item
+    summary = {"kind": kind, "path": str(path), "output": str(output), "status": 0, "files": 0, "bytesIn": 0, "bytesOut": 0, "model": False, "log": ""}
+    start = time.perf_counter()
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            if kind == "folder":
+                model = (Path(path)/"effModel").exists() # The same check rebuild() makes
+                if model or any(child.is_dir() and child.name.isnumeric() for child in Path(path).iterdir()):
+                    useFilelist = False
+                Path(output).parent.mkdir(parents=True,exist_ok=True)
+                summary["status"] = rebuild(path,output,model,compress,useFilelist,1,None,False,False,"",level)
+                summary["bytesIn"] = get_folder_size(path)
+                summary["bytesOut"] = os.path.getsize(output)
+                summary["files"] = count_files(output,model)
+            else:
+                buf = map_file(path)
+                model = kind == "effModel"
+                lines = []
+                if useFilelist and not model:
+                    lines = parse_filelist("./filelist.txt")
+                useFilelist = matches_filelist(buf,lines) # Only the BIN the file list was made for gets its names
+                with open(path, "rb") as input_file:
+                    summary["status"] = unpack(buf,f"{output}/",model,useFilelist,False,1,input_file.fileno(),False,False,path)
+                summary["bytesIn"] = len(buf)
+                summary["bytesOut"] = get_folder_size(output)
+                summary["files"] = count_files(path,model)
+            summary["model"] = model
+    except Exception as error: # One bad archive shouldn't take the rest of the batch with it
+        summary["status"] = -1
+        print(f"{type(error).__name__}: {error}", file=log)
+    if summary["status"] != 0:
+        summary["log"] = log.getvalue()
+    summary["seconds"] = time.perf_counter()-start
+    return summary
+
+def run_batch(inpath, outpath="", mode="auto", compress=True, useFilelist=True, jobs=1, level="default"): # Unpack or rebuild every archive found, several at once. Returns the summaries
+    items = find_batch_items(inpath,mode)
+    useFilelist = useFilelist and Path("./filelist.txt").is_file()
+    outputs = {}
+    for (kind,path,relPath) in items:
+        if kind == "folder":
+            output = (Path(outpath)/relPath if outpath else path).parent/f"{path.name}.bin"
+        else:
+            output = (Path(outpath)/relPath if outpath else path).with_suffix("")
+        outputs[str(path)] = [kind,path,output]
+    tasks = []
+    claimed = {} # Output to the archive that gets to write it
+    for (kind,path,output) in outputs.values():
+        if str(output) in outputs: # Unpacking one would overwrite the other, and which one wins would be down to timing
+            print(f"Skipping {path}: {output} is in the batch too. Use --batch unpack or --batch rebuild to pick one")
+            continue
+        if str(output) in claimed: # Same goes for two archives with the same output
+            print(f"Skipping {path}: {claimed[str(output)]} is already being written to {output}")
+            continue
+        claimed[str(output)] = path
+        tasks.append([kind,path,output,compress,useFilelist,level])
+    if len(tasks) == 0:
+        print(f"Nothing to unpack or rebuild in {inpath}")
+        return []
+
+    loaded = {}
+    if useFilelist: # Parse it once here instead of once per worker
+        parse_filelist("./filelist.txt")
+        loaded = dict(LOADED_FILELISTS)
+    summaries = []
+    if jobs <= 1:
+        init_batch_worker(loaded)
+        for task in tasks:
+            summaries.append(run_batch_item(task))
+            print_batch_summary(summaries[-1])
+    else:
+        from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED # Slow to import, and most runs don't need it
+        with ProcessPoolExecutor(max_workers=jobs,initializer=init_batch_worker,initargs=(loaded,)) as pool:
+            pending = set()
+            remaining = iter(tasks)
+            for task in itertools.islice(remaining,jobs): # One archive per worker at a time, so memory stays bounded by the job count
+                pending.add(pool.submit(run_batch_item,task))
+            while pending:
+                (done,pending) = wait(pending,return_when=FIRST_COMPLETED)
+                for future in done:
+                    summaries.append(future.result())
+                    print_batch_summary(summaries[-1])
+                    for task in itertools.islice(remaining,1):
+                        pending.add(pool.submit(run_batch_item,task))
+    failed = sum(1 for summary in summaries if summary["status"] != 0)
+    print(f"Batch complete: {len(summaries)-failed} of {len(summaries)} archive(s) processed successfully")
+    return summaries
+
+def print_batch_summary(summary): # One line per archive, plus whatever it printed if it failed
+    action = "Rebuilt" if summary["kind"] == "folder" else "Unpacked"
+    kind = "effModel" if summary["model"] else "BIN"
+    if summary["status"] != 0:
+        print(f"Failed {summary['path']} after {summary['seconds']:.2f}s:")
+        print(summary["log"].rstrip())
+        return 0
+    speed = summary["bytesIn"]/summary["seconds"]/0x100000 if summary["seconds"] > 0 else 0
+    print(f"{action} {kind} {summary['path']} -> {summary['output']}: {summary['files']} file(s), {summary['bytesIn']/0x100000:.1f} MB in, {summary['bytesOut']/0x100000:.1f} MB out, {summary['seconds']:.2f}s ({speed:.1f} MB/s)")
+    return 0
+
+class ArchiveEntry: # Everything the header knows about one file, like zipfile's ZipInfo
+    __slots__ = ("folder", "file", "name", "type", "size", "offset", "storedSize", "compressed", "checksum")
+
+    def __init__(self, folder, file, offset, storedSize, compressed, checksum):
+        self.folder = folder
+        self.file = file
+        self.name = None # Filled in by Archive.infolist()
+        self.type = None # Ditto, from determine_extension()
+        self.size = None # Ditto. Uncompressed, as the compressed data says
+        self.offset = offset
+        self.storedSize = storedSize # As it is in the BIN, compressed or not
+        self.compressed = compressed
+        self.checksum = checksum
+
+    def __repr__(self):
+        return (f"<ArchiveEntry {self.folder}/{self.file} {self.name!r} offset=0x{self.offset:X} size={self.size} stored={self.storedSize} compressed={self.compressed}>")
+
+    def as_dict(self):
+        return {"folder": self.folder, "file": self.file, "name": self.name, "type": self.type, "size": self.size, "offset": self.offset, "storedSize": self.storedSize, "compressed": bool(self.compressed), "checksum": self.checksum}
+
+class EntryReader(io.RawIOBase): # Reads one file out of a BIN, decompressing a little at a time
+    def __init__(self, buf, offset, size, compressed=0, chunkSize=0x10000):
+        self.view = memoryview(buf)
+        self.compressed = compressed
+        self.chunkSize = chunkSize
+        self.produced = 0
+        self.start = offset
+        if compressed == 1:
+            size += get_align_difference(size) # The English patch messed up the sizes
+            self.expected = ru32(buf,offset)
+            self.position = offset+4
+            self.decompressor = zlib.decompressobj()
+        else:
+            self.position = offset
+        self.end = offset+size
+
+    def readable(self):
+        return True
+
+    def get_stored_size(self): # How much of the BIN the file really takes up, once it's been read to the end. None if it hasn't
+        if not self.compressed:
+            return self.end-self.start
+        if not self.decompressor.eof:
+            return None
+        return min(self.position,self.end)-len(self.decompressor.unused_data)-self.start # The header size might be short, so go by where the stream stopped
+
+    def readfull(self, b): # Keep reading until b is full or the file runs out
+        view = memoryview(b).cast("B")
+        count = 0
+        while count < len(view):
+            read = self.readinto(view[count:])
+            if read == 0:
+                break
+            count += read
+        return count
+
+    def readinto(self, b):
+        if not self.compressed:
+            size = min(len(b),self.end-self.position)
+            b[0:size] = self.view[self.position:self.position+size]
+            self.position += size
+            return size
+        while True:
+            if self.decompressor.eof or (self.position >= self.end and not self.decompressor.unconsumed_tail): # Nothing left to decompress
+                if not self.decompressor.eof: # Ran out of data before the stream ended, same as zlib.decompress() would complain about
+                    raise zlib.error("Error -5 while decompressing data: incomplete or truncated stream")
+                if self.produced != self.expected:
+                    print(f"Incorrect file size specified! Attempting to ignore...")
+                    self.expected = self.produced # Only complain once
+                return 0
+            if self.decompressor.unconsumed_tail: # Left over from last time we ran out of room
+                data = self.decompressor.decompress(self.decompressor.unconsumed_tail,len(b))
+            else:
+                data = self.decompressor.decompress(self.view[self.position:min(self.position+self.chunkSize,self.end)],len(b))
+                self.position += self.chunkSize
+            if len(data) > 0:
+                b[0:len(data)] = data
+                self.produced += len(data)
+                return len(data)
+
+def iter_file_data(buf,offset,size,compressed=0,chunkSize=0x40000,reader=None): # Get a file a piece at a time, so big files never sit in memory whole. Pass in a reader to ask it about the file afterwards
+    if compressed == 1:
+        if reader is None:
+            reader = EntryReader(buf,offset,size,compressed)
+        while True:
+            chunk = bytearray(chunkSize)
+            count = reader.readfull(chunk) # Full pieces, so the first one is always enough to name the file
+            if count == 0:
+                break
+            yield memoryview(chunk)[0:count]
+    elif size > 0:
+        yield memoryview(buf)[offset:offset+size] # Already as small as it gets, since it's only a view
+
+def read_file_into(buf,offset,size,compressed,out): # Decompress a file into a buffer the caller already has. Returns how much was written
+    return EntryReader(buf,offset,size,compressed).readfull(out)
+
+def get_stream_size(buf,offset,size): # Where a compressed file really ends, size prefix included, going through the whole stream to find out. None if it never does
+    slot = memoryview(buf)[offset:offset+size+get_align_difference(size)]
+    decompressor = zlib.decompressobj()
+    data = slot[4:]
+    while len(data) > 0 and not decompressor.eof: # We only want to know where it ends, so the output goes nowhere
+        decompressor.decompress(data,0x100000)
+        data = decompressor.unconsumed_tail
+    if not decompressor.eof:
+        return None
+    return len(slot)-len(decompressor.unused_data)
+
+def get_file_head(buf,offset,size,compressed=0,length=8): # Get just the start of a file, decompressing as little as possible
+    if compressed == 1:
+        head = bytearray(length)
+        count = EntryReader(buf,offset,size,compressed,0x100).readfull(head)
+        return bytes(head[0:count])
+    return bytes(memoryview(buf)[offset:offset+min(size,length)])
+
+class Archive: # Read-only access to a BIN from other scripts, a bit like zipfile.ZipFile
+    def __init__(self, path, model=False, useFilelist=True, qbFile=False, cacheSize=32, filelistPath="./filelist.txt"):
+        self.path = path
+        self.model = model
+        self.qbFile = qbFile
+        self.buf = map_file(path)
+        self.folderCount = ru32(self.buf,0x00) # Number of folders
+        self.effModel = model and ru32(self.buf,0x08) != 0x20031205 # 9/0 (game/eff/eff.bin) is a unique case
+        self.lines = []
+        if useFilelist and not model and Path(filelistPath).is_file(): # Model files can't use the list
+            self.lines = parse_filelist(filelistPath)
+        self.files = parse_header(self.buf,self.folderCount,self.effModel)
+        self.entries = [ArchiveEntry(i,j,*self.files[i][j]) for i in range(self.folderCount) for j in range(len(self.files[i]))]
+        self.names = None # Name to entry, once we've worked the names out
+        self.cacheSize = cacheSize # How many decoded files to keep around
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path, model=False, useFilelist=True, qbFile=False, cacheSize=32, filelistPath="./filelist.txt"):
+        return cls(path,model,useFilelist,qbFile,cacheSize,filelistPath)
+
+    def close(self):
+        self.cache.clear()
+        if self.buf is not None:
+            self.buf.release()
+            self.buf = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def infolist(self):
+        if self.names is None: # Naming a file might mean peeking inside it, so only do it when asked
+            self.names = {}
+            for entry in self.entries:
+                head = get_file_head(self.buf,entry.offset,entry.storedSize,entry.compressed)
+                entry.name = get_file_name(head,entry.folder,entry.file,self.lines,self.model,self.qbFile)
+                entry.type = determine_extension(head,self.qbFile)
+                if entry.compressed == 1 and entry.storedSize >= 4: # The size is the first thing in the compressed data
+                    entry.size = ru32(self.buf,entry.offset)
                 else:
-                    outpath = (f"{Path(outpath).parent}/{Path(args.inpath).stem}_{args.folder}")
+                    entry.size = entry.storedSize
+                self.names[entry.name] = entry
+        return self.entries
+
+    def query(self, folders=None, patterns=None, types=None, minSize=None, maxSize=None): # Entries matching every filter given. Only the header and the start of each file are read
+        matched = []
+        for entry in self.infolist():
+            if folders is not None and entry.folder not in folders:
+                continue
+            if patterns and not any(fnmatch.fnmatchcase(name,pattern) for pattern in patterns for name in (f"{entry.folder}/{entry.file}",entry.name)):
+                continue
+            if types and entry.type not in types:
+                continue
+            if (minSize is not None and entry.size < minSize) or (maxSize is not None and entry.size > maxSize): # Going by the uncompressed size
+                continue
+            matched.append(entry)
+        return matched
+
+    def namelist(self):
+        return [entry.name for entry in self.infolist()]
+
+    def getinfo(self, name): # Takes a name, a (folder, file) pair or an entry
+        if isinstance(name, ArchiveEntry):
+            return name
+        if isinstance(name, tuple):
+            if name[0] < self.folderCount and name[1] < len(self.files[name[0]]):
+                return self.entries[sum(len(folder) for folder in self.files[0:name[0]])+name[1]]
         else:
-            outpath = (f"{Path(args.inpath).parent}/{Path(args.inpath).stem}") # Finally, the default case.
+            self.infolist()
+            if name in self.names:
+                return self.names[name]
+        raise KeyError(f"There is no file {name} in this BIN!")
+
+    def read(self, name):
+        entry = self.getinfo(name)
+        key = (entry.folder,entry.file)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key) # Most recently used goes last
+                return self.cache[key]
+        fileData = bytes(get_file_data(self.buf,entry.offset,entry.storedSize,entry.compressed))
+        with self.lock:
+            self.cache[key] = fileData
+            while len(self.cache) > self.cacheSize:
+                self.cache.popitem(last=False) # Least recently used goes first
+        return fileData
+
+    def open_entry(self, name): # A file object that decompresses as it's read
+        entry = self.getinfo(name)
+        return io.BufferedReader(EntryReader(self.buf,entry.offset,entry.storedSize,entry.compressed))
+
+def print_listing(entries, asJson=False): # A table of entries, or JSON for other tools
+    if asJson:
+        print(json.dumps([entry.as_dict() for entry in entries],indent=1))
+        return 0
+    print(f"{'Entry':<9} {'Type':<4} {'Size':>10} {'Stored':>10} {'Z':<1} {'Sum':<4} {'Offset':>10}  Name")
+    for entry in entries:
+        print(f"{entry.folder:>3}/{entry.file:<5} {entry.type:<4} {entry.size:>10} {entry.storedSize:>10} {'z' if entry.compressed else '-'} 0x{entry.checksum:02X} 0x{entry.offset:08X}  {entry.name}")
+    print(f"{len(entries)} file(s), {sum(entry.size for entry in entries)} bytes uncompressed, {sum(entry.storedSize for entry in entries)} bytes stored.")
+    return 0
+
+def main(argv=None):
+    import argparse # Only the command line needs this
+    parser = argparse.ArgumentParser(description='Phantom Blood PS2 BIN Extractor/Rebuilder') # QuickBMS doesn't know what these are
+    parser.add_argument("inpath", help="File Input (BIN/Folder)") # But I do
+    parser.add_argument("-o", "--outpath", type=str, default="", help="Optional. The name used for the output folder or file.")
+    parser.add_argument("-nc", "--nocompress", action="store_true", help="Optional. BIN output only. Disables ZLib compression on files within the BIN.") # For if you want the chunkiest possible game directory
+    parser.add_argument("-cl", "--level", choices=list(COMPRESSION_LEVELS), default="default", help="Optional. BIN output only. How hard to compress: \"fast\" for test builds, \"max\" for release, or \"auto\" to try several settings and keep the smallest, leaving files uncompressed when that doesn't save any sectors.")
+    parser.add_argument("-m", "--model", action="store_true", help="Optional. Indicates a BIN file or folder is formatted as a model file.") # There are BIN files inside BIN files. It gets weirder
+    parser.add_argument("-qb", "--qbextensions", action="store_true", help="Optional. BIN input only. Gives PGM and DAT extensions in place of TEX/TX2 and LXE.") # For compatibility and nostalgia
+    parser.add_argument("-nl", "--nolist", action="store_true", help="Optional. Ignores the provided file list, if available.") # Ditto
+    parser.add_argument("-fo", "--folder", type=int, default="-1", help="Optional. Extracts files from the desired folder, or specifies insertion folder.") # Ditto
+    parser.add_argument("-fi", "--file", type=int, default="-1", help="Optional. Extracts the desired file from a folder, or specifies insertion file.") # Ditto
+    parser.add_argument("-i", "--insert", type=str, default="", help="Optional. Indicates the file to insert at the provided folder and file number.") # Ditto
+    parser.add_argument("-il", "--insertlist", type=str, default="", help="Optional. A list of files to insert, one \"folder/file:path\" per line. All of them are inserted in a single pass.") # Translations touch a lot of files
+    parser.add_argument("-ip", "--inplace", action="store_true", help="Optional. Insertion only. Patches the input BIN directly, overwriting files in place when the new ones fit in the old space.") # Most patches do fit
+    parser.add_argument("-p", "--pattern", type=str, action="append", default=[], help="Optional. BIN input only. Extracts files whose \"folder/file\" number or file list name matches this pattern. Can be given more than once.") # For when you need a lot of files but not all of them
+    parser.add_argument("-ls", "--list", nargs="?", const="table", choices=["table", "json"], help="Optional. BIN input only. Lists every file with its size, compression, checksum and type instead of extracting, as a table or as JSON. Narrowed down by --folder, --pattern, --type, --minsize and --maxsize.") # Reads nothing past the first few bytes of each file
+    parser.add_argument("-t", "--type", type=str, action="append", default=[], help="Optional. With --list, only lists files of this type (e.g. \"tex\"). Can be given more than once.")
+    parser.add_argument("-mn", "--minsize", type=int, default=None, help="Optional. With --list, only lists files at least this many bytes in size, uncompressed.")
+    parser.add_argument("-mx", "--maxsize", type=int, default=None, help="Optional. With --list, only lists files at most this many bytes in size, uncompressed.")
+    parser.add_argument("-v", "--verify", action="store_true", help="Optional. BIN input only. Checks every file in the BIN against its header checksum instead of extracting.")
+    parser.add_argument("-df", "--diff", type=str, default="", help="Optional. BIN input only. Writes a patch holding only the files that differ between the input BIN and this one.") # Translation updates don't need the whole BIN
+    parser.add_argument("-ap", "--apply", type=str, default="", help="Optional. BIN input only. Applies a patch made with --diff to the input BIN.")
+    parser.add_argument("-r", "--recursive", action="store_true", help="Optional. BIN input only. Also unpacks model files found inside the BIN, next to where they are extracted.") # No more unpacking them one at a time
+    parser.add_argument("-b", "--batch", nargs="?", const="auto", choices=["auto", "unpack", "rebuild"], help="Optional. Treats the input as a directory or glob and unpacks every BIN and rebuilds every unpacked folder found, with --jobs archives at once. \"unpack\" or \"rebuild\" limits it to one or the other.") # A whole disc at once
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Optional. Number of files to process at once during a full unpack or rebuild.") # The big BIN has a lot of files
+    parser.add_argument("-inc", "--incremental", action="store_true", help="Optional. Folder input only. Copies files that haven't changed since the last unpack or rebuild straight from that BIN, going by the folder's manifest.json.")
+    parser.add_argument("-dd", "--dedupe", action="store_true", help="Optional. Folder input only. Stores identical files once and points every copy at the same data. Not possible for effModel BINs.") # Lots of placeholder textures out there
+    parser.add_argument("-dr", "--dedupereport", type=str, default="", help="Optional. With --dedupe, saves every group of identical files and the space saved to this file as JSON.")
+    parser.add_argument("-c", "--cache", action="store_true", help="Optional. Folder input only. Keeps compressed files in a cache next to the input folder, so later rebuilds only recompress changed files.") # Modding is mostly rebuilding
+    parser.add_argument("-cs", "--cachesize", type=int, default=1024, help="Optional. Maximum size of the compression cache in megabytes. Defaults to 1024.")
+    parser.add_argument("-st", "--stats", action="store_true", help="Optional. Prints how long each phase of the work took, with bytes in and out and call counts.") # For finding out where the time goes
+    parser.add_argument("-sj", "--statsjson", type=str, default="", help="Optional. Saves the same stats as --stats to this file as JSON.")
+    parser.add_argument("-pr", "--profile", type=str, default="", help="Optional. Runs under cProfile and saves the profile to this file, for pstats or snakeviz.")
 
-        if not args.insert and not (len(args.outpath) > 0 and not args.file == -1):
-            if not outpath == "./": # .// would look strange in the output
-                outpath += "/"
+    args = parser.parse_args(argv)
 
-        output_folder = outpath.rsplit("/",1)[0]+"/" # Split output into folder and filename
-        output_file = outpath.rsplit("/",1)[1]
+    compress = not args.nocompress # For convenience
+    filelist = not args.nolist
+    if args.model or not Path("./filelist.txt").is_file(): # If we don't have a file list, we don't have it
+        filelist = False # And if we're handling the file as a model we can't use the list anyway
+    if args.folder == -1: # Let's not look for a file without a folder to look in
+        args.file = -1
+    if args.file == -1 or not (Path(args.insert).is_file() and not Path(args.insert).is_dir()):
+        args.insert = False # And we can't insert anything if we don't know where to look
+    if not Path(args.insertlist).is_file():
+        args.insertlist = ""
 
-        if args.insert: # Insertion needs the most parts to work. Let's handle that first
-            Path(output_folder).mkdir(parents=True,exist_ok=True) # Make the necessary folder
-            ins = insert_file(input_buffer,args.insert,outpath,args.folder,args.file,args.model,compress)
-            if ins == 0: # That's right, we're using status codes now. Deal with it
-                print(f"Successfully inserted {args.insert} into {outpath}")
+    stats = None
+    if args.stats or args.statsjson:
+        stats = enable_stats()
+    profiler = None
+    if args.profile:
+        import cProfile # Only needed when asked for
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    if args.batch: # Every archive gets worked out on its own, model or not
+        run_batch(args.inpath,args.outpath,args.batch,compress,not args.nolist,args.jobs,args.level)
+    elif args.inplace and (args.insert or args.insertlist) and not (args.list or args.verify or args.diff or args.apply) and Path(args.inpath).is_file(): # In-place patching leaves everything else where it is. It rewrites or replaces the input, so we can't have it open here
+        if args.insertlist:
+            lines = []
+            if filelist:
+                lines = parse_filelist("./filelist.txt")
+            replacements = parse_insert_list(args.insertlist,lines)
         else:
-            if not args.model and not (len(args.outpath) > 0 and not args.file == -1): # Do NOT make "model-/"!
-                Path(output_folder).mkdir(parents=True,exist_ok=True)
-            if not args.folder == -1: # Folder/file extraction is next...
-                if not args.file == -1: # Individual file
-                    ex = extract_file(input_buffer,output_folder,args.folder,args.file,args.model,filelist,args.qbextensions,output_file)
-                    if ex == 0:
-                        print(f"Successfully extracted file {args.folder}/{args.file} to {outpath}")
-                else: # Folder extraction
-                    if args.model and ru32(input_buffer,0x08) != 0x20031205: # We know how many files are in an effModel folder
-                        file_count = 4
-                        for i in range(file_count): # Or at least we know the maximum.
-                            if ru32(input_buffer,0x04+i*0x04) == 0: # So if we find a file with size 0, we have our file count
-                                file_count = i
+            replacements = [[args.folder,args.file,Path(args.insert)]]
+        ins = -1
+        if replacements != -1: # It will have said what was wrong already
+            ins = patch_files(args.inpath,replacements,args.model,compress,args.jobs,None,args.level)
+        if ins == 0:
+            print(f"Successfully patched {len(replacements)} file(s) in {args.inpath}")
+    elif Path(args.inpath).is_file() and not Path(args.inpath).is_dir(): # BIN input is assumed
+        with open(args.inpath, "rb") as input_file: # Uncompressed files can be copied from here directly
+            input_buffer = map_file(args.inpath) # Only the parts we actually touch get read
+
+            outpath = "./"
+            if len(args.outpath) > 0: # Outpath takes priority!!
+                outpath += args.outpath
+            elif args.insert or args.insertlist: # After that is insertion, since that is based on an existing file
+                outpath = (f"{Path(args.inpath).parent}/{Path(args.inpath).stem}_modified{Path(args.inpath).suffix}")
+            elif args.diff: # Patches are named after both BINs
+                outpath = (f"{Path(args.inpath).parent}/{Path(args.inpath).stem}_to_{Path(args.diff).stem}.patch")
+            elif args.apply:
+                outpath = (f"{Path(args.inpath).parent}/{Path(args.inpath).stem}_patched{Path(args.inpath).suffix}")
+            elif not args.folder == -1: # Then check for individual folder/file...
+                if args.file == -1: # We can get away with just sending an individual file to the input directory
+                    if args.model: # If we have a model file, we should specify it.
+                        outpath = (f"{Path(outpath).parent}/model-{Path(args.inpath).stem}_{args.folder}")
                     else:
-                        file_count = ru32(input_buffer,0x14+(0x10*args.folder)) # For regular files, we have to look
-                    for i in range(file_count): # Folder extraction. Iterate over files in the folder
-                        ex = extract_file(input_buffer,output_folder,args.folder,i,args.model,filelist,args.qbextensions,output_file)
+                        outpath = (f"{Path(outpath).parent}/{Path(args.inpath).stem}_{args.folder}")
+            else:
+                outpath = (f"{Path(args.inpath).parent}/{Path(args.inpath).stem}") # Finally, the default case.
+
+            if not (args.insert or args.insertlist or args.diff or args.apply) and not (len(args.outpath) > 0 and not args.file == -1):
+                if not outpath == "./": # .// would look strange in the output
+                    outpath += "/"
+
+            output_folder = outpath.rsplit("/",1)[0]+"/" # Split output into folder and filename
+            output_file = outpath.rsplit("/",1)[1]
+
+            if args.list: # Neither listing nor verification write anything, so they come before everything else
+                with Archive(args.inpath,args.model,filelist,args.qbextensions) as archive:
+                    folders = None
+                    if not args.folder == -1:
+                        folders = [args.folder]
+                    print_listing(archive.query(folders,args.pattern,[fileType.lower() for fileType in args.type],args.minsize,args.maxsize),args.list == "json")
+            elif args.verify:
+                start = time.perf_counter()
+                (checked,mismatches) = verify_checksums(input_buffer,args.model)
+                elapsed = time.perf_counter()-start
+                for (folder,file,expected,actual,fileTime) in mismatches:
+                    print(f"Checksum mismatch in file {folder}/{file}: header says 0x{expected:02X}, data gives 0x{actual:02X} ({fileTime*1000:.3f} ms)")
+                print(f"Verified {checked} file(s) in {elapsed:.3f} seconds. {len(mismatches)} mismatch(es) found.")
+            elif args.diff: # Neither do patches, but they do need both BINs
+                Path(output_folder).mkdir(parents=True,exist_ok=True)
+                df = diff_bins(input_buffer,map_file(args.diff),outpath,args.model)
+                if df == 0:
+                    print(f"Successfully wrote patch from {args.inpath} to {args.diff} to {outpath}")
+            elif args.apply:
+                Path(output_folder).mkdir(parents=True,exist_ok=True)
+                ap = apply_patch(input_buffer,args.apply,outpath)
+                if ap == 0:
+                    print(f"Successfully applied {args.apply} to {args.inpath} as {outpath}")
+            elif args.insert: # Insertion needs the most parts to work. Let's handle that first
+                Path(output_folder).mkdir(parents=True,exist_ok=True) # Make the necessary folder
+                ins = insert_file(input_buffer,args.insert,outpath,args.folder,args.file,args.model,compress,args.level)
+                if ins == 0: # That's right, we're using status codes now. Deal with it
+                    print(f"Successfully inserted {args.insert} into {outpath}")
+            elif args.insertlist: # Batch insertion works the same way, just with more files
+                Path(output_folder).mkdir(parents=True,exist_ok=True)
+                lines = []
+                if filelist:
+                    lines = parse_filelist("./filelist.txt")
+                replacements = parse_insert_list(args.insertlist,lines)
+                ins = -1
+                if replacements != -1:
+                    ins = insert_files(input_buffer,replacements,outpath,args.model,compress,args.jobs,None,None,args.level)
+                if ins == 0:
+                    print(f"Successfully inserted {len(replacements)} file(s) into {outpath}")
+            else:
+                if not args.model and not (len(args.outpath) > 0 and not args.file == -1) and not (args.folder == -1 and args.pattern): # Do NOT make "model-/"! Patterns make only the folders they need
+                    Path(output_folder).mkdir(parents=True,exist_ok=True)
+                if not args.folder == -1: # Folder/file extraction is next...
+                    if not args.file == -1: # Individual file
+                        ex = extract_file(input_buffer,output_folder,args.folder,args.file,args.model,filelist,args.qbextensions,output_file,input_file.fileno())
+                        if ex == 0:
+                            print(f"Successfully extracted file {args.folder}/{args.file} to {outpath}")
+                    else: # Folder extraction
+                        if args.model and ru32(input_buffer,0x08) != 0x20031205: # We know how many files are in an effModel folder
+                            file_count = 4
+                            for i in range(file_count): # Or at least we know the maximum.
+                                if ru32(input_buffer,0x04+i*0x04) == 0: # So if we find a file with size 0, we have our file count
+                                    file_count = i
+                        else:
+                            file_count = ru32(input_buffer,0x14+(0x10*args.folder)) # For regular files, we have to look
+                        folder_files = [(args.folder,i) for i in range(file_count)] # Folder extraction. Every file in the folder, in one pass
+                        ex = extract_files(input_buffer,output_folder,folder_files,args.model,filelist,args.qbextensions,output_file,input_file.fileno(),True,args.jobs)
+                        if ex == 0:
+                            print(f"Successfully extracted folder {args.folder} to {outpath}")
+                elif args.pattern: # Pattern extraction keeps the usual folder structure
+                    ex = extract_files(input_buffer,output_folder,args.pattern,args.model,filelist,args.qbextensions,"",input_file.fileno(),False,args.jobs)
                     if ex == 0:
-                        print(f"Successfully extracted folder {args.folder} to {outpath}")
-            else: # Otherwise, it's time for the standard unpack
-                un = unpack(input_buffer, output_folder, args.model, filelist, args.qbextensions)
-                if un == 0:
-                    print(f"Successfully unpacked BIN to {output_folder}")
-        input_file.close()
-
-elif Path(args.inpath).is_dir(): # BIN output is assumed
-    if args.outpath: # Outpath takes priority, again
-        outpath = args.outpath
-    else: # Otherwise, nothing better to do than the default
-        outpath = (f"{Path(args.inpath).stem}.bin")
-
-    re = rebuild(args.inpath, outpath, args.model, compress, filelist) # Rebuild time.
-    if re == 0:
-        print(f"Successfully rebuilt BIN to {outpath}")
\ No newline at end of file
+                        print(f"Successfully extracted matching files to {output_folder}")
+                else: # Otherwise, it's time for the standard unpack
+                    un = unpack(input_buffer, output_folder, args.model, filelist, args.qbextensions, args.jobs, input_file.fileno(), args.recursive, True, args.inpath)
+                    if un == 0:
+                        print(f"Successfully unpacked BIN to {output_folder}")
+
+    elif Path(args.inpath).is_dir(): # BIN output is assumed
+        if args.outpath: # Outpath takes priority, again
+            outpath = args.outpath
+        else: # Otherwise, nothing better to do than the default
+            outpath = (f"{Path(args.inpath).stem}.bin")
+
+        cache = None
+        if args.cache:
+            cache = CompressionCache(get_cache_path(args.inpath),args.cachesize*1024*1024)
+        re = rebuild(args.inpath, outpath, args.model, compress, filelist, args.jobs, cache, args.incremental, args.dedupe, args.dedupereport, args.level) # Rebuild time.
+        if re == 0:
+            print(f"Successfully rebuilt BIN to {outpath}")
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        print(f"Profile saved to {args.profile}")
+    if stats is not None:
+        disable_stats()
+        print(stats.report())
+        if args.statsjson:
+            stats.save(args.statsjson)
+    return 0
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
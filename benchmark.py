@@ -0,0 +1,228 @@
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import PBPS2bin # The synthetic BINs are always built with the copy next to this script, whatever is being timed
+
+QUIRK_OFFSETS = {12: 0x52A800, 27: 0x29D2000} # Where 12/0 and 27/0 live in the vanilla BIN. parse_header() only fixes them up at these offsets
+
+def make_file_data(rng, size, ratio): # A file that zlib squeezes to roughly ratio times its size
+    randomSize = int(size*ratio)
+    return b"P2TX"+rng.getrandbits(randomSize*8).to_bytes(randomSize,"little")+bytes(max(size-randomSize-4,0))
+
+def get_file_size(rng, distribution, maxSize): # One file size, following the chosen distribution
+    if distribution == "fixed":
+        return maxSize
+    if distribution == "lognormal": # Lots of small files and a few big ones, like the real thing
+        return max(16,min(maxSize,int(rng.lognormvariate(0,1)*maxSize/8)))
+    return rng.randint(maxSize//4,maxSize)
+
+def make_synthetic_folder(folder, folderCount=4, fileCount=250, fileSize=0x8000, seed=0, distribution="uniform", ratio=0.25): # Unpacked BIN with made-up contents, so we don't need the game files
+    rng = random.Random(seed)
+    totalSize = 0
+    for i in range(folderCount):
+        Path(f"{folder}/{i}").mkdir(parents=True,exist_ok=True)
+        for j in range(fileCount):
+            fileData = make_file_data(rng,get_file_size(rng,distribution,fileSize),ratio)
+            totalSize += len(fileData)
+            with open(f"{folder}/{i}/{j}.bin", "wb") as outfile:
+                outfile.write(fileData)
+    return totalSize
+
+def make_synthetic_bin(folder, output, compress=True, effModel=False, quirk=False): # Pack a synthetic folder the way the game's own tools would have
+    folderPaths = sorted((path for path in Path(folder).iterdir() if path.is_dir()),key=lambda path: int(path.name))
+    headerarray = []
+    payloads = [] # [Folder, file, packed data including padding]
+    for curFolder in folderPaths:
+        i = int(curFolder.name)
+        filePaths = sorted(curFolder.iterdir(),key=lambda path: int(path.stem))
+        if effModel:
+            filePaths = filePaths[0:4] # eff.bin only has room for four files a folder
+        headerarray.append([])
+        for j, filePath in enumerate(filePaths):
+            databuffer = bytearray()
+            (fileSize,checksum,compressed) = PBPS2bin.append_file(filePath,databuffer,i,compress,effModel)
+            headerarray[-1].append([0,fileSize,compressed,checksum])
+            payloads.append([i,j,databuffer])
+    header = PBPS2bin.rebuild_header(headerarray,effModel)
+    if effModel or not quirk: # rebuild_header() lays the files out one after another already
+        with open(output, "wb") as outfile:
+            outfile.write(header)
+            for (i,j,databuffer) in payloads:
+                outfile.write(databuffer)
+        return 0
+    if len(headerarray) < 28 or len(headerarray[12]) == 0 or len(headerarray[27]) == 0:
+        raise ValueError("The 12/27 header quirk needs at least 28 folders")
+    reserved = sorted([QUIRK_OFFSETS[i],len(databuffer)] for (i,j,databuffer) in payloads if j == 0 and i in QUIRK_OFFSETS)
+    offsets = {}
+    position = len(header)
+    for (i,j,databuffer) in payloads: # Everything else goes around the two files pinned to their vanilla offsets
+        if j == 0 and i in QUIRK_OFFSETS:
+            offsets[(i,j)] = QUIRK_OFFSETS[i]
+            continue
+        for (start,length) in reserved:
+            if position < start+length and position+len(databuffer) > start:
+                position = start+length
+        offsets[(i,j)] = position
+        position += len(databuffer)
+    for i in range(len(headerarray)): # Point every record at where its file really is
+        recordOffset = PBPS2bin.ru32(header,0x10+(0x10*i))
+        for j in range(len(headerarray[i])):
+            header[recordOffset+(0x10*j):recordOffset+(0x10*j)+4] = PBPS2bin.wu32(offsets[(i,j)])
+    first12 = PBPS2bin.ru32(header,0x10+(0x10*12)) # Then swap 12/0 and 27/0, like the vanilla header does
+    first27 = PBPS2bin.ru32(header,0x10+(0x10*27))
+    (header[first12:first12+0x10],header[first27:first27+0x10]) = (header[first27:first27+0x10],header[first12:first12+0x10])
+    with open(output, "wb") as outfile: # Gaps are left as holes, so the file stays small on disk
+        outfile.write(header)
+        for (i,j,databuffer) in payloads:
+            outfile.seek(offsets[(i,j)])
+            outfile.write(databuffer)
+        outfile.truncate(max(offsets[(i,j)]+len(databuffer) for (i,j,databuffer) in payloads)) # In case the last file written isn't the last one in the BIN
+    return 0
+
+def run_script(script, arguments, cwd): # Time one run of the script. Returns [seconds, peak RSS in bytes or None]
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, str(script)] + arguments, cwd=cwd, stdout=subprocess.DEVNULL)
+    peakRss = None
+    if hasattr(os, "wait4"): # Only the child's own peak counts, not every child we've ever run
+        (_,status,usage) = os.wait4(process.pid,0)
+        status = os.waitstatus_to_exitcode(status) # wait4() gives the raw wait status, not the exit code
+        process.returncode = status
+        peakRss = usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss*1024
+    else:
+        status = process.wait()
+    seconds = time.perf_counter()-start
+    if status != 0:
+        raise subprocess.CalledProcessError(status,process.args)
+    return [seconds,peakRss]
+
+def get_supported_options(script): # Every option the script's --help lists, so older versions can skip what they don't have
+    helpText = subprocess.run([sys.executable, str(script), "-h"], check=True, capture_output=True, text=True).stdout
+    return set(re.findall(r"(?<![\w-])(--?[A-Za-z]+)",helpText))
+
+def get_operations(sizes): # [Name, arguments, bytes processed, files processed]
+    return [
+        ["rebuild", ["synthetic", "-nl", "-o", "rebuilt.bin"], sizes["total"], sizes["files"]],
+        ["rebuild (no compression)", ["synthetic", "-nl", "-nc", "-o", "rebuilt_nc.bin"], sizes["total"], sizes["files"]],
+        ["unpack", ["synthetic.bin", "-nl", "-o", "unpacked"], sizes["total"], sizes["files"]],
+        ["unpack (no compression)", ["synthetic_nc.bin", "-nl", "-o", "unpacked_nc"], sizes["total"], sizes["files"]],
+        ["extract folder", ["synthetic.bin", "-nl", "-fo", "1", "-o", "folder"], sizes["folder"], sizes["folderFiles"]],
+        ["extract file", ["synthetic.bin", "-nl", "-fo", "1", "-fi", "0", "-o", "file.bin"], sizes["file"], 1],
+        ["insert", ["synthetic.bin", "-nl", "-fo", "0", "-fi", "0", "-i", "synthetic/1/1.bin", "-o", "inserted.bin"], sizes["bin"], 1],
+        ["checksum", ["synthetic.bin", "-nl", "-v"], sizes["bin"], sizes["files"]],
+        ["unpack (effModel)", ["eff.bin", "-m", "-o", "eff_unpacked"], sizes["eff"], sizes["effFiles"]],
+        ["rebuild (effModel)", ["eff_unpacked", "-m", "-o", "eff_rebuilt.bin"], sizes["eff"], sizes["effFiles"]],
+    ]
+
+def run_benchmarks(script, workdir, sizes, repeat=3, jobs=1): # Best of several runs for each operation
+    results = []
+    supported = get_supported_options(script)
+    for (name,arguments,byteCount,fileCount) in get_operations(sizes):
+        if jobs > 1 and name not in ("extract file","insert","checksum") and "-j" in supported:
+            arguments = arguments + ["-j", str(jobs)]
+        missing = [argument for argument in arguments if argument.startswith("-") and argument not in supported]
+        if missing:
+            print(f"Skipping {name} for {script.name}: it doesn't support {', '.join(missing)}")
+            continue
+        runs = [run_script(script,arguments,workdir) for _ in range(repeat)]
+        seconds = min(run[0] for run in runs)
+        peakRss = None
+        if runs[0][1] is not None:
+            peakRss = max(run[1] for run in runs)
+        results.append({"name": name, "seconds": seconds, "mbPerSecond": byteCount/seconds/0x100000, "filesPerSecond": fileCount/seconds, "peakRssMB": None if peakRss is None else peakRss/0x100000})
+    return results
+
+def print_results(results, compared=None): # One line per operation, with a speedup column if there's something to compare against
+    if compared is None:
+        print(f"{'Operation':<28}{'Time':>10}{'MB/s':>10}{'Files/s':>10}{'RSS MB':>10}")
+        for result in results:
+            peakRss = "-" if result["peakRssMB"] is None else f"{result['peakRssMB']:.1f}"
+            print(f"{result['name']:<28}{result['seconds']:>9.3f}s{result['mbPerSecond']:>10.1f}{result['filesPerSecond']:>10.0f}{peakRss:>10}")
+        return 0
+    others = {result["name"]: result for result in compared}
+    print(f"{'Operation':<28}{'Current':>10}{'Compared':>10}{'Speedup':>10}{'RSS MB':>10}{'Compared':>10}")
+    for result in results:
+        other = others.get(result["name"])
+        if other is None: # Older runs won't have every operation
+            continue
+        peakRss = "-" if result["peakRssMB"] is None else f"{result['peakRssMB']:.1f}"
+        otherRss = "-" if other["peakRssMB"] is None else f"{other['peakRssMB']:.1f}"
+        print(f"{result['name']:<28}{result['seconds']:>9.3f}s{other['seconds']:>9.3f}s{other['seconds']/result['seconds']:>9.1f}x{peakRss:>10}{otherRss:>10}")
+    return 0
+
+def get_commit(script): # So saved results say what they measured
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(script).parent, check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='PBPS2bin benchmark on a synthetic BIN')
+    parser.add_argument("-s", "--script", type=str, default=str(Path(__file__).parent/"PBPS2bin.py"), help="Optional. Script to benchmark.")
+    parser.add_argument("-c", "--compare", type=str, default="", help="Optional. Another version of the script to compare against, e.g. from git show.")
+    parser.add_argument("-b", "--baseline", type=str, default="", help="Optional. Results saved earlier with --json to compare against.")
+    parser.add_argument("-js", "--json", type=str, default="", help="Optional. Save the results here as JSON.")
+    parser.add_argument("-fo", "--folders", type=int, default=4, help="Optional. Number of folders in the synthetic BIN.")
+    parser.add_argument("-fi", "--files", type=int, default=250, help="Optional. Number of files per folder.")
+    parser.add_argument("-sz", "--size", type=int, default=0x8000, help="Optional. Maximum file size in bytes.")
+    parser.add_argument("-d", "--distribution", choices=["uniform", "lognormal", "fixed"], default="uniform", help="Optional. How file sizes are spread up to the maximum.")
+    parser.add_argument("-cr", "--ratio", type=float, default=0.25, help="Optional. Roughly how small zlib gets each file, from 0 (all zeroes) to 1 (incompressible).")
+    parser.add_argument("-q", "--quirk", action="store_true", help="Optional. Swap the 12/0 and 27/0 records like the vanilla header. Needs at least 28 folders.")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Optional. Passed on to the operations that support it.")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Optional. Runs per operation. The best one counts.")
+    parser.add_argument("--seed", type=int, default=0, help="Optional. Seed for the synthetic files.")
+
+    args = parser.parse_args(argv)
+    if args.quirk and args.folders < 28:
+        parser.error("--quirk needs at least 28 folders")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        totalSize = make_synthetic_folder(f"{workdir}/synthetic",args.folders,args.files,args.size,args.seed,args.distribution,args.ratio)
+        make_synthetic_bin(f"{workdir}/synthetic",f"{workdir}/synthetic.bin",True,False,args.quirk)
+        make_synthetic_bin(f"{workdir}/synthetic",f"{workdir}/synthetic_nc.bin",False,False,args.quirk)
+        make_synthetic_bin(f"{workdir}/synthetic",f"{workdir}/eff.bin",False,True)
+        folderPaths = list(Path(f"{workdir}/synthetic/1").iterdir())
+        effPaths = [path for i in range(args.folders) for path in sorted(Path(f"{workdir}/synthetic/{i}").iterdir(),key=lambda path: int(path.stem))[0:4]]
+        sizes = {
+            "total": totalSize,
+            "files": args.folders*args.files,
+            "folder": sum(path.stat().st_size for path in folderPaths),
+            "folderFiles": len(folderPaths),
+            "file": Path(f"{workdir}/synthetic/1/0.bin").stat().st_size,
+            "bin": Path(f"{workdir}/synthetic.bin").stat().st_size,
+            "eff": sum(path.stat().st_size for path in effPaths),
+            "effFiles": len(effPaths),
+        }
+        results = run_benchmarks(Path(args.script).resolve(),workdir,sizes,args.repeat,args.jobs)
+        compared = None
+        if args.compare:
+            compared = run_benchmarks(Path(args.compare).resolve(),workdir,sizes,args.repeat,args.jobs)
+        elif args.baseline:
+            with open(args.baseline) as baseline_file:
+                compared = json.load(baseline_file)["results"]
+    print_results(results,compared)
+
+    if args.json:
+        report = {
+            "commit": get_commit(args.script),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "settings": {key: value for key, value in vars(args).items() if key not in ("json","baseline","compare","script")},
+            "results": results,
+        }
+        with open(args.json, "w") as json_file:
+            json.dump(report,json_file,indent=4)
+    return 0
+
+if __name__ == "__main__":
+    main()